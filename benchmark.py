@@ -0,0 +1,189 @@
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import portfolio
+import solvers
+from optionchain import OptionParamIndex, OptionChainStore
+from pricing import black76, yearsToExpiry
+
+# times each stage of the pipeline run by gammerscarpling.py on synthetic chains of
+# strikes x expiries x rights options and prints one JSON object per (size, stage):
+#
+#   python benchmark.py --sizes 10x4x2,20x8x2 --out bench.json
+#   python benchmark.py --baseline bench.json     # exit status 1 if a stage got slower
+#
+# Stages: optionParams (OptionParamIndex ingestion and windowing), chainTicks (OptionChainStore rows
+# plus ticksPerOption model ticks per option, reported per tick), dataFrame (to_pandas plus the
+# duration step), prune (pruneChain, with the options it cut), replicate (the 31-way
+# replicate-and-concat), modelBuild and modelSolve (pyomo, the replicated formulation),
+# quantityModelBuild and quantityModelSolve (the integer quantity one), milpBuild and milpSolve
+# (QuantityMILP, the one the script uses, on a solvers.py backend) and combo (BAG contract and order
+# from the selected rows).
+
+TODAY = datetime.date(2018, 10, 28)
+
+
+def syntheticChain(nStrikes, nExpiries, nRights, undPrice=2800., strikeStep=5.):
+    # what TWS sends for such a chain: option parameters and one model tick per option
+    expirations = [(TODAY + datetime.timedelta(weeks=i + 1)).strftime("%Y%m%d") for i in range(nExpiries)]
+    strikes = undPrice + strikeStep * (np.arange(nStrikes) - nStrikes // 2)
+    rights = ["C", "P"][:nRights]
+    (exps, stks, rts) = [a.ravel() for a in np.meshgrid(expirations, strikes, rights, indexing="ij")]
+    T = yearsToExpiry(exps, now=datetime.datetime.combine(TODAY, datetime.time()))
+    greeks = black76(undPrice, stks, T, 0.2, 0., rts == "C")
+    return (expirations, strikes, exps, stks, rts, greeks, undPrice)
+
+
+def fillStore(chain, nTicks=1):
+    (expirations, strikes, exps, stks, rts, greeks, undPrice) = chain
+    store = OptionChainStore()
+    store.reserve(len(exps))
+    for (reqId, (exp, stk, rt)) in enumerate(zip(exps, stks, rts)):
+        store.addRow(reqId, symbol="ES", right=rt, strikes=stk, expirations=exp, multiplier=50., conId=reqId + 1,
+                     exchange="GLOBEX")
+    (gamma, theta, delta, vega, price) = [greeks[name].tolist() for name in ("gamma", "theta", "delta", "vega", "price")]
+    for _ in range(nTicks):
+        for reqId in range(len(exps)):
+            store.set(reqId, gamma=gamma[reqId], theta=theta[reqId], delta=delta[reqId], vega=vega[reqId],
+                      undPrice=undPrice, impliedVol=0.2, optPrice=price[reqId])
+    return store
+
+
+def timeit(fn, repeat):
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return (times, result)
+
+
+def benchSize(nStrikes, nExpiries, nRights, repeat, solverName, ticksPerOption, milpSolverName=None):
+    chain = syntheticChain(nStrikes, nExpiries, nRights)
+    (expirations, strikes, exps, stks, rts, greeks, undPrice) = chain
+    nOptions = len(exps)
+    results = []
+
+    def record(stage, times, n=1, **extra):
+        results.append(dict(stage=stage, strikes=nStrikes, expiries=nExpiries, rights=nRights, options=nOptions,
+                            n=n, repeat=len(times), min=min(times), median=float(np.median(times)),
+                            perItem=float(np.median(times)) / n, **extra))
+
+    def optionParams():
+        params = OptionParamIndex()
+        params.add("GLOBEX", "ES", "50", set(expirations), set(float(s) for s in strikes))
+        params.build()
+        return (params.expiryWindow(expirations[0], expirations[-1]), params.strikeWindow(undPrice, 8, 8))
+
+    (times, _) = timeit(optionParams, repeat)
+    record("optionParams", times)
+
+    (times, store) = timeit(lambda: fillStore(chain, ticksPerOption), repeat)
+    record("chainTicks", times, n=nOptions * ticksPerOption)
+
+    (times, df) = timeit(lambda: portfolio.prepareChain(store.to_pandas(), TODAY.strftime("%Y%m%d")), repeat)
+    record("dataFrame", times, n=nOptions)
+    rawdata = df[portfolio.RAW_COLUMNS]
+
+    (times, pruned) = timeit(lambda: portfolio.pruneChain(rawdata), repeat)
+    record("prune", times, n=nOptions, cut=nOptions - len(pruned))
+    rawdata = pruned
+
+    (times, inputdata) = timeit(lambda: portfolio.replicateChain(rawdata), repeat)
+    record("replicate", times, n=len(inputdata))
+
+    (times, model) = timeit(lambda: portfolio.buildModel(inputdata), repeat)
+    record("modelBuild", times, n=len(inputdata))
+
+    (times, quantityModel) = timeit(lambda: portfolio.buildQuantityModel(rawdata), repeat)
+    record("quantityModelBuild", times, n=nOptions)
+
+    (times, milpModel) = timeit(lambda: portfolio.QuantityMILP(rawdata), repeat)
+    record("milpBuild", times, n=nOptions, nonzeros=milpModel.A.nnz)
+    milpSolver = solvers.makeSolver(milpSolverName)
+    (times, _) = timeit(lambda: milpModel.solve(milpSolver, warmStart=False), repeat)
+    record("milpSolve", times, n=nOptions, solver=milpSolver.name, objective=milpModel.objective)
+
+    re_df = None
+    if solverName:
+        from pyomo.opt import SolverFactory
+        solver = SolverFactory(solverName)
+        if solver.available(exception_flag=False):
+            (times, _) = timeit(lambda: solver.solve(model), repeat)
+            record("modelSolve", times, n=len(inputdata), solver=solverName)
+            (times, _) = timeit(lambda: solver.solve(quantityModel), repeat)
+            record("quantityModelSolve", times, n=nOptions, solver=solverName)
+            re_df = portfolio.selectedQuantities(quantityModel, rawdata)
+        else:
+            for stage in ("modelSolve", "quantityModelSolve"):
+                results.append(dict(stage=stage, strikes=nStrikes, expiries=nExpiries, rights=nRights,
+                                    options=nOptions, skipped="solver %s not available" % solverName))
+    if re_df is None:
+        re_df = milpModel.selected()
+    if re_df.empty:
+        # a 3-leg selection so the combo stage is timed without a solver
+        re_df = inputdata.iloc[[0, len(rawdata), 2 * len(rawdata)]]
+
+    (times, _) = timeit(lambda: portfolio.comboOrder(re_df), repeat)
+    record("combo", times, n=len(re_df))
+    return results
+
+
+def compare(results, baselinePath, tolerance):
+    # stages whose median is more than tolerance slower than in the baseline file
+    key = lambda r: (r["stage"], r["strikes"], r["expiries"], r["rights"])
+    with open(baselinePath) as f:
+        baseline = {key(r): r for r in map(json.loads, f) if "median" in r}
+    return [(r, baseline[key(r)]) for r in results
+            if "median" in r and key(r) in baseline and r["median"] > baseline[key(r)]["median"] * (1 + tolerance)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the option chain and portfolio pipeline stages.")
+    parser.add_argument("--sizes", default="10x4x2,20x8x2,40x12x2",
+                        help="comma separated strikes x expiries x rights, e.g. 20x8x2")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--ticks", type=int, default=4, help="model ticks per option in chainTicks")
+    parser.add_argument("--solver", default="highs", help="pyomo solver for modelSolve, empty to skip")
+    parser.add_argument("--milp-solver", help="solvers.makeSolver spec for milpSolve, default highs or scipy")
+    parser.add_argument("--out", help="append the JSON lines to this file as well")
+    parser.add_argument("--baseline", help="JSON lines of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    env = dict(python=platform.python_version(), numpy=np.__version__, pandas=pd.__version__,
+               machine=platform.machine(), stamp=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    results = []
+    for size in args.sizes.split(","):
+        (nStrikes, nExpiries, nRights) = (int(n) for n in size.split("x"))
+        for result in benchSize(nStrikes, nExpiries, nRights, args.repeat, args.solver, args.ticks,
+                                args.milp_solver):
+            result.update(env)
+            results.append(result)
+            print(json.dumps(result))
+            sys.stdout.flush()
+
+    if args.out:
+        with open(args.out, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+    if args.baseline:
+        slower = compare(results, args.baseline, args.tolerance)
+        for (result, base) in slower:
+            sys.stderr.write("slower: %s %sx%sx%s %.4fs vs %.4fs\n" % (result["stage"], result["strikes"],
+                             result["expiries"], result["rights"], result["median"], base["median"]))
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,17 @@
 import sys
+import atexit
+import bisect
 import collections
 import datetime
 import inspect
-from threading import Thread
+from threading import Thread, Lock, Event, current_thread
+import concurrent.futures
+import queue
 
 import logging
+import logging.handlers
 import time
+import asyncio
 import os.path
 
 from ibapi import wrapper
@@ -28,8 +34,21 @@ from ibapi.account_summary_tags import *
 import pandas as pd
 import numpy as np
 
+from optionchain import ContractCache, OptionParamIndex, OptionChainStore
+from pricing import fillModelGreeks, VolSurface
+from replay import CallbackRecorder
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    # hands the raw record over, formatting happens on the listener thread
+    def prepare(self, record):
+        return record
+
 
 def SetupLogger():
+    # the file and console handlers run on a QueueListener thread so the EReader thread never
+    # formats or writes; returns the listener, which is stopped at exit so the records still queued
+    # are written even when the script fails half way
     if not os.path.exists("log"):
         os.makedirs("log")
     time.strftime("pyibapi.%Y%m%d_%H%M%S.log")
@@ -37,15 +56,28 @@ def SetupLogger():
     recfmt = '(%(threadName)s) %(asctime)s.%(msecs)03d %(levelname)s %(filename)s:%(lineno)d %(message)s'
     timefmt = '%y%m%d_%H:%M:%S'
 
-    logging.basicConfig(filename=time.strftime("log/pyibapi.%y%m%d_%H%M%S.log"),
-                        filemode='w',
-                        level=logging.INFO,
-                        format=recfmt,
-                        datefmt=timefmt)
-    logger = logging.getLogger()
+    fileHandler = logging.FileHandler(time.strftime("log/pyibapi.%y%m%d_%H%M%S.log"), mode='w')
+    fileHandler.setFormatter(logging.Formatter(recfmt, timefmt))
     console = logging.StreamHandler()
     console.setLevel(logging.WARNING)
-    logger.addHandler(console)
+
+    logQueue = queue.Queue()
+    listener = logging.handlers.QueueListener(logQueue, fileHandler, console, respect_handler_level=True)
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(RecordQueueHandler(logQueue))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+# one logger per high-volume callback, logging at DEBUG so they cost a level check unless enabled,
+# e.g. cbLog["tickPrice"].setLevel(logging.DEBUG)
+cbLog = {name: logging.getLogger("callback." + name) for name in (
+    "tickPrice", "tickSize", "tickGeneric", "tickString", "tickOptionComputation", "contractDetails",
+    "contractDetailsEnd", "securityDefinitionOptionParameter", "headTimestamp", "histogramData",
+    "historicalData", "historicalDataEnd", "historicalDataUpdate", "historicalTicks", "historicalTicksBidAsk",
+    "historicalTicksLast")}
 
 
 def printWhenExecuting(fn):
@@ -63,116 +95,579 @@ def printinstance(inst: Object):
 
 
 class Activity(Object):
+    # one traced request: ansMsgId is the answer kind that counts as its first answer (None for any
+    # answer) and ansEndMsgId the one that completes it; kinds are named like ReqFutures kinds
     def __init__(self, reqMsgId, ansMsgId, ansEndMsgId, reqId):
         self.reqMsgId = reqMsgId
         self.ansMsgId = ansMsgId
         self.ansEndMsgId = ansEndMsgId
         self.reqId = reqId
+        self.sent = time.time()
+        self.firstAns = None
+        self.end = None
+        self.errorCode = None
+
+
+class LatencyHistogram(Object):
+    # log-spaced bins of 100us..1000s, 20 per decade, so percentiles are within ~12% at constant memory
+    EDGES = list(np.logspace(-4, 3, 141))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.EDGES) + 1)
+        self.n = 0
+        self.max = 0.
+
+    def add(self, latency):
+        self.counts[bisect.bisect_right(self.EDGES, latency)] += 1
+        self.n += 1
+        self.max = max(self.max, latency)
+
+    def percentile(self, q):
+        # upper edge of the bin holding the q-th percentile, q in [0, 100]
+        if self.n == 0:
+            return np.nan
+        rank = q / 100. * self.n
+        cum = 0
+        for (i, count) in enumerate(self.counts):
+            cum += count
+            if count and cum >= rank:
+                return min(self.EDGES[i], self.max) if i < len(self.EDGES) else self.max
+        return self.max
 
 
 class RequestMgr(Object):
+    # send, first answer, end and error of every traced request, plus latency histograms per
+    # (request, stage) where stage is 'first' or 'end'. A reqId can carry several requests (the
+    # chain fetch sends contract details and market data under one id), so activities are kept
+    # per reqId and request. receivedMsg runs on the EReader thread.
     def __init__(self):
-        self.requests = []
+        self.lock = Lock()
+        self.requests = collections.defaultdict(dict)
+        self.histograms = collections.defaultdict(LatencyHistogram)
 
     def addReq(self, req):
-        self.requests.append(req)
+        with self.lock:
+            self.requests[req.reqId][req.reqMsgId] = req
+
+    def receivedMsg(self, reqId, kind):
+        now = time.time()
+        with self.lock:
+            for req in self.requests.get(reqId, {}).values():
+                if req.end is not None:
+                    continue
+                if req.firstAns is None and (req.ansMsgId is None or kind == req.ansMsgId):
+                    req.firstAns = now
+                    self.histograms[(req.reqMsgId, 'first')].add(now - req.sent)
+                if kind == req.ansEndMsgId:
+                    req.end = now
+                    self.histograms[(req.reqMsgId, 'end')].add(now - req.sent)
+
+    def receivedError(self, reqId, errorCode):
+        # the error ends every request still open under reqId
+        now = time.time()
+        with self.lock:
+            for req in self.requests.get(reqId, {}).values():
+                if req.end is None:
+                    req.end = now
+                    req.errorCode = errorCode
+
+    def percentiles(self, qs=(50, 90, 99)):
+        with self.lock:
+            rows = [(reqMsgId, stage, hist.n) + tuple(hist.percentile(q) for q in qs) + (hist.max,)
+                    for ((reqMsgId, stage), hist) in sorted(self.histograms.items())]
+        return pd.DataFrame(rows, columns=['request', 'stage', 'n'] + ['p%g' % q for q in qs] + ['max']) \
+            .set_index(['request', 'stage'])
+
+    def to_pandas(self):
+        # one row per traced request, times in seconds after the request was sent
+        with self.lock:
+            rows = [(req.reqId, req.reqMsgId, req.sent,
+                     req.firstAns - req.sent if req.firstAns is not None else np.nan,
+                     req.end - req.sent if req.end is not None else np.nan, req.errorCode)
+                    for reqs in self.requests.values() for req in reqs.values()]
+        return pd.DataFrame(rows, columns=['reqId', 'request', 'sent', 'firstAns', 'end', 'errorCode']) \
+            .set_index('reqId')
+
+
+class ReqError(Exception):
+    def __init__(self, reqId, errorCode, errorString):
+        Exception.__init__(self, "reqId %s: error %s %s" % (reqId, errorCode, errorString))
+        self.reqId = reqId
+        self.errorCode = errorCode
+        self.errorString = errorString
 
-    def receivedMsg(self, msg):
-        pass
+
+class ReqFutures(Object):
+    # completion futures keyed by (reqId, answer kind), resolved from the EReader thread so
+    # waiters wake as soon as the callback runs instead of on the next poll
+    def __init__(self):
+        self.lock = Lock()
+        self.reqId2futures = {}
+        self.future2items = {}
+
+    def expect(self, reqId, kind):
+        fut = concurrent.futures.Future()
+        with self.lock:
+            self.reqId2futures.setdefault(reqId, {})[kind] = fut
+        return fut
+
+    def collect(self, reqId, kind, item):
+        # buffers multi-message answers (contractDetails rows, option parameter rows) until the
+        # end message resolves the future with the whole list
+        if reqId not in self.reqId2futures:
+            return
+        with self.lock:
+            fut = self.reqId2futures.get(reqId, {}).get(kind)
+            if fut is not None:
+                self.future2items.setdefault(fut, []).append(item)
+
+    def resolve(self, reqId, kind, result=None):
+        if reqId not in self.reqId2futures:
+            return
+        with self.lock:
+            kinds = self.reqId2futures.get(reqId, {})
+            fut = kinds.pop(kind, None)
+            if not kinds:
+                self.reqId2futures.pop(reqId, None)
+            items = self.future2items.pop(fut, None)
+        if fut is not None:
+            fut.set_result(items if result is None else result)
+
+    def fail(self, reqId, errorCode, errorString):
+        if reqId not in self.reqId2futures:
+            return
+        with self.lock:
+            kinds = self.reqId2futures.pop(reqId, {})
+            for fut in kinds.values():
+                self.future2items.pop(fut, None)
+        for fut in kinds.values():
+            fut.set_exception(ReqError(reqId, errorCode, errorString))
+
+    def discard(self, reqId):
+        with self.lock:
+            for fut in self.reqId2futures.pop(reqId, {}).values():
+                self.future2items.pop(fut, None)
+
+
+class IdAllocator(Object):
+    # hands out increasing ids, singly or as contiguous blocks, from any thread
+    def __init__(self, start=None):
+        self.lock = Lock()
+        self.next = start
+
+    def take(self, n=1):
+        # first id of a block of n
+        with self.lock:
+            if self.next is None:
+                raise RuntimeError("id allocator not synchronized yet (no nextValidId)")
+            first = self.next
+            self.next += n
+        return first
+
+    def reserve(self, n):
+        first = self.take(n)
+        return range(first, first + n)
+
+    def resync(self, nextValid):
+        # never moves backwards, ids already handed out stay unique
+        with self.lock:
+            if nextValid is None or self.next is None or nextValid > self.next:
+                self.next = nextValid
+
+
+class MktDataLine(Object):
+    def __init__(self, contract, priority):
+        self.contract = contract
+        self.priority = priority
+        self.subscribedAt = None
+        self.lastTick = None
+        self.lastModel = None
+        self.nModel = 0
+
+
+class MktDataScheduler(Object):
+    # TWS only allows maxLines simultaneous market data lines (100 by default, error 101 beyond).
+    # Contracts are registered under a fixed reqId; rotate() keeps at most maxLines of them
+    # subscribed, releasing lines that delivered a model tick or dwelled `dwell` seconds, and gives
+    # free lines to the waiting contracts that are most overdue, weighted by priority. An error 101
+    # shrinks the budget to the lines actually open. start() rotates every period seconds on a thread
+    # of its own until stop() or the connection is lost.
+    def __init__(self, app, maxLines=100, dwell=10., genericTickList=""):
+        self.app = app
+        self.maxLines = maxLines
+        self.dwell = dwell
+        self.genericTickList = genericTickList
+        self.lock = Lock()
+        self.reqId2line = {}
+        self.active = set()
+        self.stopped = Event()
+        self.thread = None
+
+    def __contains__(self, reqId):
+        return reqId in self.reqId2line
+
+    def add(self, reqId, contract, priority=1.):
+        with self.lock:
+            self.reqId2line[reqId] = MktDataLine(contract, priority)
+
+    def remove(self, reqId):
+        with self.lock:
+            self.reqId2line.pop(reqId, None)
+            wasActive = reqId in self.active
+            self.active.discard(reqId)
+        if wasActive:
+            self.app.cancelMktData(reqId)
+
+    def onTick(self, reqId, model=False):
+        # EReader thread
+        line = self.reqId2line.get(reqId)
+        if line is None:
+            return
+        line.lastTick = time.time()
+        if model:
+            line.lastModel = line.lastTick
+            line.nModel += 1
+
+    def onLimit(self, reqId):
+        # error 101: the subscription was refused, the account has fewer lines than assumed
+        with self.lock:
+            if reqId in self.active:
+                self.active.discard(reqId)
+                self.reqId2line[reqId].subscribedAt = None
+                self.maxLines = max(len(self.active), 1)
+        logging.warning('market data line limit reached, budget now %d lines', self.maxLines)
+
+    def overdue(self, line, now):
+        if line.lastModel is None:
+            return np.inf
+        return (now - line.lastModel) * line.priority
+
+    def rotate(self):
+        now = time.time()
+        with self.lock:
+            waiting = sorted((reqId for reqId in self.reqId2line if reqId not in self.active),
+                             key=lambda reqId: self.overdue(self.reqId2line[reqId], now), reverse=True)
+            nNeeded = len(waiting) - (self.maxLines - len(self.active))
+            releasable = [reqId for reqId in self.active
+                          if (self.reqId2line[reqId].lastModel or 0) >= self.reqId2line[reqId].subscribedAt
+                          or now - self.reqId2line[reqId].subscribedAt >= self.dwell]
+            releasable.sort(key=lambda reqId: self.reqId2line[reqId].subscribedAt)
+            release = releasable[:max(nNeeded, 0)]
+            self.active.difference_update(release)
+            subscribe = waiting[:max(self.maxLines - len(self.active), 0)]
+            for reqId in subscribe:
+                self.active.add(reqId)
+                self.reqId2line[reqId].subscribedAt = now
+        for reqId in release:
+            self.reqId2line[reqId].subscribedAt = None
+            self.app.cancelMktData(reqId)
+        for reqId in subscribe:
+            self.app.reqMktData(reqId, self.reqId2line[reqId].contract, self.genericTickList, False, False, [])
+        return len(release), len(subscribe)
+
+    def run(self, period=1.):
+        while not self.stopped.is_set() and not self.app.connectionLost():
+            self.rotate()
+            self.stopped.wait(period)
+
+    def start(self, period=1.):
+        self.thread = Thread(target=self.run, args=(period,), name="mktdata", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def coverage(self):
+        # per contract: priority, subscribed now, model ticks so far and seconds since the last one
+        now = time.time()
+        with self.lock:
+            rows = [(reqId, line.priority, reqId in self.active, line.nModel,
+                     now - line.lastModel if line.lastModel is not None else np.nan)
+                    for (reqId, line) in self.reqId2line.items()]
+        return pd.DataFrame(rows, columns=['reqId', 'priority', 'subscribed', 'nModel', 'staleness']).set_index('reqId')
+
+
+class TokenBucket(Object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.time()
+
+    def take(self):
+        # reserves one token, returns how long the caller has to wait before using it
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= 1
+        return max(-self.tokens / self.rate, 0.)
 
 
 class TestClient(EClient):
-    def __init__(self, wrapper):
+    # TWS disconnects clients sending more than 50 messages per second
+    HISTORICAL_METHODS = ('reqHistoricalData', 'reqHistoricalTicks', 'reqHistogramData', 'reqHeadTimeStamp')
+
+    def __init__(self, wrapper, maxMsgPerSec=45, msgBurst=5, instrument=False):
         EClient.__init__(self, wrapper)
 
-        self.clntMeth2callCount = collections.defaultdict(int)
-        self.clntMeth2reqIdIdx = collections.defaultdict(lambda: -1)
+        # outgoing messages are queued and sent by a pacing thread at maxMsgPerSec, so callers
+        # (the EReader thread included) never block and nothing is dropped while connected. The
+        # thread starts with the first message of a connection and disconnect() ends it along with
+        # whatever it had not sent yet
+        self.msgBucket = TokenBucket(maxMsgPerSec, msgBurst)
+        self.sendLock = Lock()
+        self.sendQueue = queue.Queue()
+        self.sendThread = None
+        self.pacingStats = collections.defaultdict(float)
+        # historical data pacing: 60 requests per 10 minutes, no identical request within 15 seconds.
+        # histSent holds the send times given out so far, sorted, possibly in the future
+        self.histLock = Lock()
+        self.histSent = []
+        self.histMaxRequests = 60
+        self.histKey2sent = {}
+
+        self.setupHistoricalPacing()
+
+        # call counting is opt-in: without it no EClient method is wrapped at all
+        self.clntMethNames = []
+        self.clntCallCounts = []
         self.reqId2nReq = collections.defaultdict(int)
-        self.setupDetectReqId()
-
-    def countReqId(self, methName, fn):
-        def countReqId_(*args, **kwargs):
-            self.clntMeth2callCount[methName] += 1
-            idx = self.clntMeth2reqIdIdx[methName]
-            if idx >= 0:
-                sign = -1 if 'cancel' in methName else 1
-                self.reqId2nReq[sign * args[idx]] += 1
+        if instrument:
+            self.setupDetectReqId()
+
+    def sendMsg(self, msg):
+        with self.sendLock:
+            if self.sendThread is None:
+                # each pacing thread has a queue of its own, so one still draining after a
+                # disconnect never takes the messages of the next connection
+                self.sendQueue = queue.Queue()
+                self.sendThread = Thread(target=self.sendLoop, args=(self.sendQueue,), name="pacing", daemon=True)
+                self.sendThread.start()
+            self.sendQueue.put((msg, time.time()))
+
+    def sendLoop(self, sendQueue):
+        while True:
+            item = sendQueue.get()
+            if item is None:
+                return
+            (msg, queued) = item
+            wait = self.msgBucket.take()
+            if wait > 0:
+                time.sleep(wait)
+            self.pacingStats['nSent'] += 1
+            self.pacingStats['totalWait'] += time.time() - queued
+            self.pacingStats['maxWait'] = max(self.pacingStats['maxWait'], time.time() - queued)
+            if not self.isConnected():
+                logging.warning("dropping message queued before disconnect: %s", msg)
+                continue
+            try:
+                EClient.sendMsg(self, msg)
+            except Exception:
+                # e.g. a disconnect() from another thread closed the socket under us
+                logging.exception("sending %s failed", msg)
+
+    def stopSending(self):
+        # ends the pacing thread, dropping the messages it had not sent yet
+        with self.sendLock:
+            (thread, sendQueue) = (self.sendThread, self.sendQueue)
+            self.sendThread = None
+        if thread is None:
+            return
+        nDropped = 0
+        while True:
+            try:
+                sendQueue.get_nowait()
+            except queue.Empty:
+                break
+            nDropped += 1
+        sendQueue.put(None)
+        if nDropped:
+            logging.warning("dropped %d messages queued before disconnect", nDropped)
+        if thread is not current_thread():
+            thread.join()
+
+    def disconnect(self):
+        EClient.disconnect(self)
+        self.stopSending()
+
+    def setupHistoricalPacing(self):
+        # the request id is the first argument of every historical request and is left out of
+        # the identical-request key
+        for methName in self.HISTORICAL_METHODS:
+            setattr(self, methName, self.paceHistoricalCall(methName, getattr(self, methName)))
+
+    def paceHistoricalCall(self, methName, fn):
+        def paceHistorical_(*args, **kwargs):
+            self.paceHistorical(methName, args[1:], kwargs)
             return fn(*args, **kwargs)
 
+        return paceHistorical_
+
+    def paceHistorical(self, methName, args, kwargs):
+        # blocks the caller until the request is within the historical data pacing rules. The send
+        # time is reserved under the lock and waited for outside it, so a request with nothing to wait
+        # for is never held up by another one waiting for its slot.
+        def argKey(arg):
+            return str(vars(arg)) if hasattr(arg, '__dict__') else str(arg)
+
+        key = (methName,) + tuple(argKey(arg) for arg in args) + \
+            tuple((name, argKey(arg)) for (name, arg) in sorted(kwargs.items()) if name not in ('reqId', 'tickerId'))
+        with self.histLock:
+            now = time.time()
+            sendAt = now
+            if len(self.histSent) >= self.histMaxRequests:
+                sendAt = self.histSent[-self.histMaxRequests] + 600
+            if key in self.histKey2sent:
+                sendAt = max(sendAt, self.histKey2sent[key] + 15)
+            bisect.insort(self.histSent, sendAt)
+            del self.histSent[:-self.histMaxRequests]
+            self.histKey2sent[key] = sendAt
+            if sendAt > now:
+                self.pacingStats['histWait'] += sendAt - now
+        if sendAt > now:
+            logging.info("historical data pacing: %s waits %.1fs", methName, sendAt - now)
+            time.sleep(sendAt - now)
+
+    def dumpPacingSituation(self):
+        nSent = self.pacingStats['nSent']
+        logging.info("pacing: %d sent, %d queued, mean wait %.4fs, max wait %.4fs, historical wait %.1fs",
+                     nSent, self.sendQueue.qsize(), self.pacingStats['totalWait'] / max(nSent, 1),
+                     self.pacingStats['maxWait'], self.pacingStats['histWait'])
+
+    def countReqId(self, methId, fn, idx, sign):
+        # idx is the position of reqId among the bound method's arguments, -1 if it has none
+        counts = self.clntCallCounts
+        reqId2nReq = self.reqId2nReq
+        if idx < 0:
+            def countReqId_(*args, **kwargs):
+                counts[methId] += 1
+                return fn(*args, **kwargs)
+        else:
+            def countReqId_(*args, **kwargs):
+                counts[methId] += 1
+                reqId2nReq[sign * (args[idx] if idx < len(args) else kwargs['reqId'])] += 1
+                return fn(*args, **kwargs)
+
         return countReqId_
 
     def setupDetectReqId(self):
-
+        # wraps this instance's bound methods only, the EClient class itself is never patched
         methods = inspect.getmembers(EClient, inspect.isfunction)
         for (methName, meth) in methods:
-            if methName != "send_msg":
-                self.clntMeth2callCount[methName] = 0
-                sig = inspect.signature(meth)
-                for (idx, pnameNparam) in enumerate(sig.parameters.items()):
-                    (paramName, param) = pnameNparam
-                    if paramName == 'reqId':
-                        self.clntMeth2reqIdIdx[methName] = idx
-
-                setattr(TestClient, methName, self.countReqId(methName, meth))
+            if methName in ("send_msg", "sendMsg") or methName.startswith("__"):
+                continue
+            params = list(inspect.signature(meth).parameters)[1:]
+            idx = params.index('reqId') if 'reqId' in params else -1
+            sign = -1 if 'cancel' in methName else 1
+            self.clntMethNames.append(methName)
+            self.clntCallCounts.append(0)
+            setattr(self, methName, self.countReqId(len(self.clntMethNames) - 1, getattr(self, methName), idx, sign))
 
 
 class TestWrapper(wrapper.EWrapper):
 
-    def __init__(self):
+    def __init__(self, instrument=False):
         wrapper.EWrapper.__init__(self)
 
-        self.wrapMeth2callCount = collections.defaultdict(int)
-        self.wrapMeth2reqIdIdx = collections.defaultdict(lambda: -1)
+        # answer counting is opt-in, see TestClient.setupDetectReqId
+        self.wrapMethNames = []
+        self.wrapCallCounts = []
         self.reqId2nAns = collections.defaultdict(int)
-        self.setupDetectWrapperReqId()
-
-    def countWrapReqId(self, methName, fn):
-        def countWrapReqId_(*args, **kwargs):
-            self.wrapMeth2callCount[methName] += 1
-            idx = self.wrapMeth2reqIdIdx[methName]
-            if idx >= 0:
-                self.reqId2nAns[args[idx]] += 1
-            return fn(*args, **kwargs)
+        if instrument:
+            self.setupDetectWrapperReqId()
+
+    def countWrapReqId(self, methId, fn, idx):
+        counts = self.wrapCallCounts
+        reqId2nAns = self.reqId2nAns
+        if idx < 0:
+            def countWrapReqId_(*args, **kwargs):
+                counts[methId] += 1
+                return fn(*args, **kwargs)
+        else:
+            def countWrapReqId_(*args, **kwargs):
+                counts[methId] += 1
+                reqId2nAns[args[idx] if idx < len(args) else kwargs['reqId']] += 1
+                return fn(*args, **kwargs)
 
         return countWrapReqId_
 
     def setupDetectWrapperReqId(self):
-
+        # the decoder looks callbacks up on the wrapper instance, so wrapping the bound methods
+        # counts the most derived override without touching EWrapper or TestWrapper
         methods = inspect.getmembers(wrapper.EWrapper, inspect.isfunction)
         for (methName, meth) in methods:
-            self.wrapMeth2callCount[methName] = 0
-            sig = inspect.signature(meth)
-            for (idx, pnameNparam) in enumerate(sig.parameters.items()):
-                (paramName, param) = pnameNparam
-                if 'error' not in methName and paramName == 'reqId':
-                    self.wrapMeth2reqIdIdx[methName] = idx
-
-            setattr(TestWrapper, methName, self.countWrapReqId(methName, meth))
+            if methName.startswith("__"):
+                continue
+            params = list(inspect.signature(meth).parameters)[1:]
+            idx = params.index('reqId') if 'error' not in methName and 'reqId' in params else -1
+            self.wrapMethNames.append(methName)
+            self.wrapCallCounts.append(0)
+            setattr(self, methName, self.countWrapReqId(len(self.wrapMethNames) - 1, getattr(self, methName), idx))
 
 
 # %%
 class TestApp(TestWrapper, TestClient):
-    def __init__(self):
-        TestWrapper.__init__(self)
-        TestClient.__init__(self, wrapper=self)
+    # request ids live far above order ids so an error callback's id is never ambiguous
+    REQID_BASE = 1 << 30
+    # request -> (first answer, end answer) traced by traceRequests; reqMktData ends with model greeks
+    TRACED_REQUESTS = {'reqContractDetails': ('contractDetails', 'contractDetailsEnd'),
+                       'reqSecDefOptParams': ('securityDefinitionOptionParameter',
+                                              'securityDefinitionOptionParameterEnd'),
+                       'reqMktData': (None, ('tickOptionComputation', 13))}
+    # error codes after which TWS sends nothing more for a request id: pacing and line limits
+    # (100-102), no security definition or not allowed (200, 203), invalid or unprocessable requests
+    # (162, 321, 322, 354, 366, 420, 430). Warnings such as 300 (cancel of an unknown ticker) leave
+    # the request running.
+    TERMINAL_ERRORS = frozenset((100, 101, 102, 162, 200, 203, 321, 322, 354, 366, 420, 430))
+    # the same for an order id: rejected (201, 203) or cancelled (202). Other order errors, 399
+    # (order message) among them, may leave the order working.
+    ORDER_TERMINAL_ERRORS = frozenset((201, 202, 203))
+    # orderStatus values after which an order neither fills nor works any more
+    ORDER_FINAL_STATUSES = ('Filled', 'Cancelled', 'ApiCancelled', 'Inactive')
+
+    def __init__(self, instrument=False, host='127.0.0.1', port=7497, clientId=999, recorder=None, connect=True):
+        # instrument=True counts every request and callback for dumpTestCoverageSituation and
+        # dumpReqAnsErrSituation, at the cost of a wrapper call on each of them. A CallbackRecorder
+        # captures every callback of the session; connect=False leaves the app unconnected, for
+        # feeding it from a replay.ReplayDriver.
+        TestWrapper.__init__(self, instrument)
+        TestClient.__init__(self, wrapper=self, instrument=instrument)
+
+        self.orderIdAlloc = IdAllocator()
+        self.reqIdAlloc = IdAllocator(self.REQID_BASE)
 
         self.nKeybInt = 0
         self.started = False
-        self.nextValidOrderId = None
         self.permId2ord = {}
+        # orderId -> filled quantity as of the last orderStatus
+        self.orderId2filled = {}
         self.reqId2nErr = collections.defaultdict(int)
         self.reqGlobalCancelOnly = False
         self.simplePlaceOid = None
         self.globalCancelOnly = False
-
-        self.reqMarketDataType(1)
-
-        self.connect('127.0.0.1', 7497, 999)
-
-        thread = Thread(target=self.run)
-        thread.start()
-
-        setattr(self, "_thread", thread)
+        self.reqFutures = ReqFutures()
+        # reqId -> callable receiving every tick/error event of a streaming subscription
+        self.reqId2listener = {}
+        self.nextValidIdFuture = self.reqFutures.expect(NO_VALID_ID, 'nextValidId')
+        # pipelined chain fetch: reqId -> (completion futures, send time)
+        self.optionchain_pending = {}
+        self.optionchain_completed = 0
+        # chain reqIds whose market data was cancelled, ticks already in flight do not cancel again
+        self.optionchain_cancelled = set()
+        self.optionchain_timedOut = 0
+        # optional ContractCache consulted before reqContractDetails
+        self.contractCache = None
+        # optional VolSurface fed with every model tick of the chain
+        self.volSurface = None
+        self.mktDataScheduler = None
+        # optional portfolio.PortfolioTracker notified of every model tick of the chain
+        self.portfolioTracker = None
+        # optional RequestMgr timing every traced request, see traceRequests
+        self.requestMgr = None
+        self.optionchain_contracts = {}
 
         self.optionchain_req_underlyingPrice = None
         self.optionchain_underlyingPrice = None
@@ -180,46 +675,94 @@ class TestApp(TestWrapper, TestClient):
         self.optionchain_req_End = False
         self.optionchain_req_chain = None
 
-        self.optionchain_strikes = []
-        self.optionchain_expirations = []
+        self.optionchain_params = OptionParamIndex()
         self.option_chain_multiplier = None
         self.optionchain_contractNum = 0
-        self.optionchain = dict(symbol={}, right={}, multiplier={}, expirations={}, strikes={}, gamma={}, conId={}, exchange={},
-                                theta={}, delta={}, vega={}, undPrice={}, impliedVol={}, optPrice={})
+        self.optionchain = OptionChainStore()
+
+        self.recorder = recorder
+        if recorder is not None:
+            recorder.attach(self)
+
+        if connect:
+            # requests sent before connect() only produce a 504 error and are lost
+            self.connect(host, port, clientId)
+            self.reqMarketDataType(1)
+
+            thread = Thread(target=self.run)
+            thread.start()
 
-    def gammascarping(self, symbol, exchange, secType, conID):
+            setattr(self, "_thread", thread)
 
-        while self.nextValidOrderId is None:
-            time.sleep(1)
+    def traceRequests(self):
+        # records an Activity for every request in TRACED_REQUESTS; the callbacks report answers
+        self.requestMgr = RequestMgr()
+        for (methName, (ansMsgId, ansEndMsgId)) in self.TRACED_REQUESTS.items():
+            setattr(self, methName, self.traceRequestCall(methName, getattr(self, methName), ansMsgId, ansEndMsgId))
+        return self.requestMgr
+
+    def traceRequestCall(self, methName, fn, ansMsgId, ansEndMsgId):
+        def traceRequest_(reqId, *args, **kwargs):
+            self.requestMgr.addReq(Activity(methName, ansMsgId, ansEndMsgId, reqId))
+            return fn(reqId, *args, **kwargs)
+
+        return traceRequest_
+
+    def dumpLatencySituation(self):
+        if self.requestMgr is None:
+            logging.info("latency: request tracing is off")
+            return
+        logging.info("request latencies in seconds:\n%s", self.requestMgr.percentiles().to_string())
+
+    def gammascarping(self, symbol, exchange, secType, conID, maxInFlight=16, strikeTimeout=30,
+                      stageTimeout=60, tradingClass=None):
+        # maxInFlight strikes are requested concurrently; a strike leaves the window once both its
+        # contractDetailsEnd and its model greeks (tickOptionComputation 13) have arrived, or after
+        # strikeTimeout seconds. Message pacing is left to TestClient. Strikes found in self.contractCache skip
+        # reqContractDetails and only wait for greeks. The connection, option parameter and underlying
+        # price stages raise TimeoutError after stageTimeout seconds, as does the chain when none of its
+        # strikes completed; a lost connection raises ConnectionError. tradingClass restricts the chain
+        # to one trading class instead of the union of all classes listed for the underlying.
+        if maxInFlight < 1:
+            raise ValueError("maxInFlight must be at least 1, got %r" % (maxInFlight,))
+
+        self.nextValidIdFuture.result(stageTimeout)
         underlyingContract = Contract()
         underlyingContract.symbol = symbol
         underlyingContract.conId = conID
         underlyingContract.exchange = exchange
 
-        self.optionchain_req_underlyingPrice = self.nextOrderId()
+        self.optionchain_req_underlyingPrice = self.nextReqId()
+        undPriceFuture = self.reqFutures.expect(self.optionchain_req_underlyingPrice, ('tickPrice', 9))
         self.reqMktData(self.optionchain_req_underlyingPrice, underlyingContract, "221", False, False, [])
 
         # 先连接到tws后调用此函数
 
-        self.optionchain_req_chain = self.nextOrderId()
+        self.optionchain_req_chain = self.nextReqId()
+        chainFuture = self.reqFutures.expect(self.optionchain_req_chain, 'securityDefinitionOptionParameterEnd')
         self.reqSecDefOptParams(self.optionchain_req_chain, symbol, exchange, secType, conID)
 
-        while self.optionchain_req_End == False:
-            time.sleep(1)
-
-        conExp = np.array(list(set(self.optionchain_expirations)))
-        conExp.sort()
-        tmp_time_s = np.searchsorted(conExp, (datetime.datetime.now()+datetime.timedelta(days=7)).strftime("%Y%m%d"))
-        tmp_time_e = np.searchsorted(conExp, (datetime.datetime.now() + datetime.timedelta(days=60)).strftime("%Y%m%d"))
-        for aexp in conExp[tmp_time_s:min(tmp_time_e, len(conExp))]:
-            while self.optionchain_underlyingPrice is None:
-                time.sleep(1)
-            conStrikes = np.array(list(set(self.optionchain_strikes)))
-            conStrikes.sort()
-            tmp_pos = np.searchsorted(conStrikes, self.optionchain_underlyingPrice)
-
-            for aprice in conStrikes[max(tmp_pos - 8, 0):min(tmp_pos + 8, len(conStrikes) - 1)]:
-                contract_req_ID = self.nextOrderId()
+        chainFuture.result(stageTimeout)
+        undPriceFuture.result(stageTimeout)
+
+        classKey = None
+        if tradingClass is not None:
+            classKey = self.optionchain_params.classKey(tradingClass, exchange)
+            self.option_chain_multiplier = classKey[2]
+        conExp = self.optionchain_params.expiryWindow(
+            (datetime.datetime.now() + datetime.timedelta(days=7)).strftime("%Y%m%d"),
+            (datetime.datetime.now() + datetime.timedelta(days=60)).strftime("%Y%m%d"), classKey)
+        conStrikes = self.optionchain_params.strikeWindow(self.optionchain_underlyingPrice, 8, 8, classKey)
+
+        self.optionchain.reserve(len(self.optionchain) + len(conExp) * len(conStrikes))
+        chainReqIds = iter(self.reqIdAlloc.reserve(len(conExp) * len(conStrikes)))
+        for aexp in conExp:
+            aexp = str(aexp)
+            for aprice in conStrikes:
+                aprice = float(aprice)
+                self.waitOptionchainWindow(maxInFlight - 1, strikeTimeout)
+
+                contract_req_ID = next(chainReqIds)
                 tmp_contract = Contract()
                 tmp_contract.symbol = symbol
                 if secType == 'STK':
@@ -231,28 +774,150 @@ class TestApp(TestWrapper, TestClient):
                 tmp_contract.lastTradeDateOrContractMonth = aexp
                 tmp_contract.strike = aprice
                 tmp_contract.right = "C"
-
-                self.optionchain['symbol'][contract_req_ID] = symbol
-                self.optionchain['right'][contract_req_ID] = 'C'
-                self.optionchain['strikes'][contract_req_ID] = aprice
-                self.optionchain['expirations'][contract_req_ID] = aexp
-
+                if tradingClass is not None:
+                    tmp_contract.tradingClass = tradingClass
+                    tmp_contract.multiplier = classKey[2]
+
+                self.optionchain.addRow(contract_req_ID, symbol=symbol, right='C', strikes=aprice, expirations=aexp)
+                self.optionchain_contracts[contract_req_ID] = tmp_contract
+
+                cached = None
+                if self.contractCache is not None:
+                    cached = self.contractCache.get(symbol, tmp_contract.secType, aexp, aprice, "C", exchange,
+                                                     tradingClass)
+                if cached is not None:
+                    (tmp_contract.conId, multiplier, tmp_contract.exchange, tmp_contract.tradingClass) = cached
+                    self.optionchain.set(contract_req_ID, conId=tmp_contract.conId, multiplier=float(multiplier or 'nan'),
+                                         exchange=tmp_contract.exchange)
+                    self.optionchain_contractNum += 1
+
+                futs = [self.reqFutures.expect(contract_req_ID, ('tickOptionComputation', 13))]
+                if cached is None:
+                    futs.append(self.reqFutures.expect(contract_req_ID, 'contractDetailsEnd'))
+                self.optionchain_pending[contract_req_ID] = (futs, time.time())
                 self.reqMktData(contract_req_ID, tmp_contract, "", False, False, [])
+                if cached is None:
+                    self.reqContractDetails(contract_req_ID, tmp_contract)
+
+        self.waitOptionchainWindow(0, strikeTimeout)
+        if self.contractCache is not None:
+            self.contractCache.flush()
+        if len(conExp) * len(conStrikes) and not self.optionchain_completed:
+            raise TimeoutError('no option chain strike completed within %ss' % strikeTimeout)
+        logging.info('option chain complete: %d contracts, %d with details, %d strikes timed out',
+                     len(self.optionchain), self.optionchain_contractNum, self.optionchain_timedOut)
+
+        # self.disconnect()
+
+    def keepChainFresh(self, maxLines=100, period=1., dwell=10.):
+        # after gammascarping: keeps rotating market data over the whole chain within the line budget,
+        # at the money strikes and near expiries refreshed most often, until mktDataScheduler.stop()
+        if self.mktDataScheduler is not None:
+            self.mktDataScheduler.stop()
+        self.mktDataScheduler = MktDataScheduler(self, maxLines, dwell)
+        undPrice = self.optionchain_underlyingPrice
+        days = (pd.to_datetime(self.optionchain['expirations'].astype(str), format='%Y%m%d')
+                - pd.Timestamp(datetime.date.today())).days.values
+        priority = 1. / ((1 + 10 * np.abs(np.log(self.optionchain['strikes'] / undPrice))) * (1 + days / 30.))
+        for (reqId, prio) in zip(self.optionchain.reqIds[:len(self.optionchain)], priority):
+            self.mktDataScheduler.add(int(reqId), self.optionchain_contracts[reqId], prio)
+        self.mktDataScheduler.start(period)
+        return self.mktDataScheduler
+
+    def waitOrderFinal(self, orderId, send, timeout):
+        # calls send() with futures on the order's final statuses in place and returns the first
+        # final status, the ReqError of a terminal order error, or None if neither came in time
+        futs = [self.reqFutures.expect(orderId, ('orderStatus', status)) for status in self.ORDER_FINAL_STATUSES]
+        send()
+        (done, _) = concurrent.futures.wait(futs, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        self.reqFutures.discard(orderId)
+        if not done:
+            return None
+        final = [fut.result() for fut in futs if fut in done and fut.exception() is None]
+        return ('Filled' if 'Filled' in final else final[0]) if final else next(iter(done)).exception()
+
+    def placeFirstFilled(self, combos, fillTimeout=30., cancelTimeout=10.):
+        # combos: (contract, order) pairs best first, e.g. portfolio.comboOrder of each of
+        # portfolio.topPortfolios' rows. Places one at a time and falls back to the next once the
+        # previous one is dead: TWS reported it Cancelled or Inactive, or rejected it (it is still
+        # cancelled, in case), or it did not fill within fillTimeout seconds and TWS confirmed its
+        # cancel within cancelTimeout. An order whose cancel is not confirmed may still be working,
+        # so the fallback stops there, as it does after a partial fill. Returns (index, orderId) of
+        # the combo that filled, or None.
+        for (i, (contract, order)) in enumerate(combos):
+            orderId = self.nextOrderId()
+            final = self.waitOrderFinal(orderId, lambda: self.placeOrder(orderId, contract, order), fillTimeout)
+            reason = final
+            if final is None:
+                final = self.waitOrderFinal(orderId, lambda: self.cancelOrder(orderId), cancelTimeout)
+                reason = 'not filled in %ss, cancelled' % fillTimeout
+                if final is None:
+                    logging.error('combo %d (order %d): not filled in %ss and its cancel was not confirmed in %ss, '
+                                  'not falling back', i, orderId, fillTimeout, cancelTimeout)
+                    return None
+            elif isinstance(final, ReqError):
+                self.cancelOrder(orderId)
+            if final == 'Filled':
+                return (i, orderId)
+            if self.orderId2filled.get(orderId, 0) > 0:
+                logging.warning('combo %d (order %d) filled %s of %s, not falling back', i, orderId,
+                                self.orderId2filled[orderId], order.totalQuantity)
+                return (i, orderId)
+            logging.warning('combo %d (order %d): %s, falling back', i, orderId, reason)
+        return None
+
+    def cancelChainMktData(self, reqId):
+        # once per reqId: TWS keeps ticking until the cancel arrives and answers a second cancel
+        # with error 300
+        if reqId not in self.optionchain_cancelled:
+            self.optionchain_cancelled.add(reqId)
+            self.cancelMktData(reqId)
 
-                self.reqContractDetails(contract_req_ID, tmp_contract)
-                while self.optionchain_contractNum < len(self.optionchain['expirations']) :
-                    time.sleep(1)
-
-                # self.disconnect()
+    def connectionLost(self):
+        # the socket closed or the thread decoding its messages died; an app fed by a ReplayDriver
+        # was never connected and never loses it
+        thread = getattr(self, "_thread", None)
+        return thread is not None and (not self.isConnected() or not thread.is_alive())
+
+    def waitOptionchainWindow(self, limit, timeout):
+        # blocks until at most `limit` chain strikes are outstanding, giving up on strikes that
+        # have not completed within `timeout` seconds. Raises ConnectionError as soon as the
+        # connection is lost, no outstanding strike could complete after that.
+        while len(self.optionchain_pending) > limit:
+            if self.connectionLost():
+                raise ConnectionError('connection to TWS lost with %d option chain strikes outstanding'
+                                      % len(self.optionchain_pending))
+            oldest = min(sent for (futs, sent) in self.optionchain_pending.values())
+            concurrent.futures.wait([fut for (futs, sent) in self.optionchain_pending.values() for fut in futs],
+                                    timeout=min(max(oldest + timeout - time.time(), 0), 1.),
+                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            now = time.time()
+            for reqId, (futs, sent) in list(self.optionchain_pending.items()):
+                if all(fut.done() for fut in futs):
+                    del self.optionchain_pending[reqId]
+                    if not any(fut.exception() for fut in futs):
+                        self.optionchain_completed += 1
+                elif now - sent >= timeout:
+                    del self.optionchain_pending[reqId]
+                    self.optionchain_timedOut += 1
+                    self.reqFutures.discard(reqId)
+                    logging.warning('option chain reqId %d timed out', reqId)
+                    if not futs[0].done():
+                        self.cancelChainMktData(reqId)
 
     @iswrapper
     def contractDetails(self, reqId: int, contractDetails: ContractDetails):
         super().contractDetails(reqId, contractDetails)
-        printinstance(contractDetails.contract)
-        if reqId in self.optionchain['expirations'].keys():
-            self.optionchain['conId'][reqId] = contractDetails.contract.conId
-            self.optionchain['multiplier'][reqId] = contractDetails.contract.multiplier
-            self.optionchain['exchange'][reqId] = contractDetails.contract.exchange
+        cbLog["contractDetails"].debug("ContractDetails. ReqId: %d %s", reqId, contractDetails.contract)
+        if reqId in self.optionchain:
+            self.optionchain.set(reqId, conId=contractDetails.contract.conId,
+                                 multiplier=float(contractDetails.contract.multiplier or 'nan'),
+                                 exchange=contractDetails.contract.exchange)
+            if self.contractCache is not None:
+                self.contractCache.put(contractDetails.contract)
+        if self.requestMgr is not None:
+            self.requestMgr.receivedMsg(reqId, 'contractDetails')
+        self.reqFutures.collect(reqId, 'contractDetailsEnd', contractDetails)
 
     @iswrapper
     def bondContractDetails(self, reqId: int, contractDetails: ContractDetails):
@@ -261,52 +926,79 @@ class TestApp(TestWrapper, TestClient):
     @iswrapper
     def contractDetailsEnd(self, reqId: int):
         super().contractDetailsEnd(reqId)
-        print("ContractDetailsEnd. ", reqId, "\n")
-        if reqId in self.optionchain['expirations'].keys():
+        cbLog["contractDetailsEnd"].debug("ContractDetailsEnd. %d", reqId)
+        if reqId in self.optionchain:
             self.optionchain_contractNum += 1
+        if self.requestMgr is not None:
+            self.requestMgr.receivedMsg(reqId, 'contractDetailsEnd')
+        self.reqFutures.resolve(reqId, 'contractDetailsEnd')
 
     @iswrapper
-    def tickOptionComputation(self, reqId: TickerId, tickType: TickType,
+    def tickOptionComputation(self, reqId: TickerId, tickType: TickType, tickAttrib: int,
                               impliedVol: float, delta: float, optPrice: float, pvDividend: float,
                               gamma: float, vega: float, theta: float, undPrice: float):
-        super().tickOptionComputation(reqId, tickType, impliedVol, delta,
+        super().tickOptionComputation(reqId, tickType, tickAttrib, impliedVol, delta,
                                       optPrice, pvDividend, gamma, vega, theta, undPrice)
-        print("TickOptionComputation. TickerId:", reqId, "tickType:", tickType,
-              "ImpliedVolatility:", impliedVol, "Delta:", delta, "OptionPrice:",
-              optPrice, "pvDividend:", pvDividend, "Gamma: ", gamma, "Vega:", vega,
-              "Theta:", theta, "UnderlyingPrice:", undPrice)
-
-        if (reqId in self.optionchain['expirations'].keys()) and (tickType == 13):
-            self.optionchain['gamma'][reqId] = gamma
-            self.optionchain['theta'][reqId] = theta
-            self.optionchain['delta'][reqId] = delta
-            self.optionchain['vega'][reqId] = vega
-            self.optionchain['undPrice'][reqId] = undPrice
-            self.optionchain['impliedVol'][reqId] = impliedVol
-            self.optionchain['optPrice'][reqId] = optPrice
-
-            self.cancelMktData(reqId)
+        cbLog["tickOptionComputation"].debug(
+            "TickOptionComputation. TickerId: %d tickType: %d ImpliedVolatility: %s Delta: %s OptionPrice: %s "
+            "pvDividend: %s Gamma: %s Vega: %s Theta: %s UnderlyingPrice: %s", reqId, tickType, impliedVol, delta,
+            optPrice, pvDividend, gamma, vega, theta, undPrice)
+
+        if (reqId in self.optionchain) and (tickType == 13):
+            self.optionchain.set(reqId, gamma=gamma, theta=theta, delta=delta, vega=vega, undPrice=undPrice,
+                                 impliedVol=impliedVol, optPrice=optPrice)
+            if self.volSurface is not None and impliedVol is not None:
+                row = self.optionchain.reqId2row[reqId]
+                self.volSurface.update(self.optionchain['expirations'][row], self.optionchain['strikes'][row],
+                                       impliedVol, undPrice)
+            if self.portfolioTracker is not None:
+                self.portfolioTracker.notify()
+
+            if self.mktDataScheduler is None or reqId not in self.mktDataScheduler:
+                self.cancelChainMktData(reqId)
+
+        if self.mktDataScheduler is not None:
+            self.mktDataScheduler.onTick(reqId, model=tickType == 13)
+        if self.requestMgr is not None:
+            self.requestMgr.receivedMsg(reqId, ('tickOptionComputation', tickType))
+
+        if reqId in self.reqId2listener:
+            self.reqId2listener[reqId](('tickOptionComputation', tickType, impliedVol, delta, optPrice,
+                                        pvDividend, gamma, vega, theta, undPrice))
+        self.reqFutures.resolve(reqId, ('tickOptionComputation', tickType),
+                                dict(impliedVol=impliedVol, delta=delta, optPrice=optPrice, pvDividend=pvDividend,
+                                     gamma=gamma, vega=vega, theta=theta, undPrice=undPrice))
 
     @iswrapper
     def tickPrice(self, reqId: TickerId, tickType: TickType, price: float,
                   attrib: TickAttrib):
         super().tickPrice(reqId, tickType, price, attrib)
-        print("Tick Price. Ticker Id:", reqId, "tickType:", tickType,
-              "Price:", price, "CanAutoExecute:", attrib.canAutoExecute,
-              "PastLimit:", attrib.pastLimit, end=' ')
-        if tickType == TickTypeEnum.BID or tickType == TickTypeEnum.ASK:
-            print("PreOpen:", attrib.preOpen)
-        else:
-            print()
+        cbLog["tickPrice"].debug("Tick Price. Ticker Id: %d tickType: %d Price: %s CanAutoExecute: %s "
+                                 "PastLimit: %s PreOpen: %s", reqId, tickType, price, attrib.canAutoExecute,
+                                 attrib.pastLimit, attrib.preOpen)
 
         if (reqId == self.optionchain_req_underlyingPrice) and (tickType == 9):
             logging.info('self.optionchain_underlyingPrice: ' + str(price))
             self.optionchain_underlyingPrice = price
-            self.cancelMktData(self.optionchain_req_underlyingPrice)
+            self.cancelChainMktData(self.optionchain_req_underlyingPrice)
             logging.info('self.optionchain_underlyingPrice STOP ')
 
-        if (reqId in self.optionchain['expirations'].keys()) and (tickType == 4):
-            self.optionchain['optPrice'][reqId] =  price
+        if reqId in self.optionchain:
+            if tickType == 4:
+                self.optionchain.set(reqId, optPrice=price)
+            elif tickType == 1:
+                self.optionchain.set(reqId, bid=price)
+            elif tickType == 2:
+                self.optionchain.set(reqId, ask=price)
+
+        if self.mktDataScheduler is not None:
+            self.mktDataScheduler.onTick(reqId)
+        if self.requestMgr is not None:
+            self.requestMgr.receivedMsg(reqId, ('tickPrice', tickType))
+
+        if reqId in self.reqId2listener:
+            self.reqId2listener[reqId](('tickPrice', tickType, price))
+        self.reqFutures.resolve(reqId, ('tickPrice', tickType), price)
 
     @iswrapper
     def securityDefinitionOptionParameter(self, reqId: int, exchange: str,
@@ -314,35 +1006,42 @@ class TestApp(TestWrapper, TestClient):
                                           expirations: SetOfString, strikes: SetOfFloat):
         super().securityDefinitionOptionParameter(reqId, exchange,
                                                   underlyingConId, tradingClass, multiplier, expirations, strikes)
-        print("Security Definition Option Parameter. ReqId:%d Exchange:%s "
-              "Underlying conId: %d TradingClass:%s Multiplier:%s Exp:%s Strikes:%s",
-              reqId, exchange, underlyingConId, tradingClass, multiplier,
-              ",".join(expirations), ",".join(str(strikes)))
+        cbLog["securityDefinitionOptionParameter"].debug(
+            "Security Definition Option Parameter. ReqId:%d Exchange:%s Underlying conId: %d TradingClass:%s "
+            "Multiplier:%s Exp:%s Strikes:%s", reqId, exchange, underlyingConId, tradingClass, multiplier,
+            expirations, strikes)
 
         if (reqId == self.optionchain_req_chain):
 
             logging.debug('self.optionchain is building: ' + str(self.optionchain_req_chain))
-            for adate in expirations:
-                for aprice in strikes:
-                    self.optionchain_expirations.append(adate)
-                    self.optionchain_strikes.append(aprice)
-                    self.option_chain_multiplier = multiplier
+            self.optionchain_params.add(exchange, tradingClass, multiplier, expirations, strikes)
+            self.option_chain_multiplier = multiplier
+
+        if self.requestMgr is not None:
+            self.requestMgr.receivedMsg(reqId, 'securityDefinitionOptionParameter')
+        self.reqFutures.collect(reqId, 'securityDefinitionOptionParameterEnd',
+                                (exchange, underlyingConId, tradingClass, multiplier, expirations, strikes))
 
     @iswrapper
     def securityDefinitionOptionParameterEnd(self, reqId: int):
         super().securityDefinitionOptionParameterEnd(reqId)
         print("Security Definition Option Parameter End. Request: ", reqId)
 
+        if reqId == self.optionchain_req_chain:
+            self.optionchain_params.build()
         self.optionchain_req_End = True
+        if self.requestMgr is not None:
+            self.requestMgr.receivedMsg(reqId, 'securityDefinitionOptionParameterEnd')
+        self.reqFutures.resolve(reqId, 'securityDefinitionOptionParameterEnd')
 
     def dumpTestCoverageSituation(self):
-        for clntMeth in sorted(self.clntMeth2callCount.keys()):
-            logging.debug("ClntMeth: %-30s %6d" % (clntMeth,
-                                                   self.clntMeth2callCount[clntMeth]))
+        if not self.clntMethNames:
+            logging.debug("test coverage: instrumentation is off")
+        for (clntMeth, count) in sorted(zip(self.clntMethNames, self.clntCallCounts)):
+            logging.debug("ClntMeth: %-30s %6d" % (clntMeth, count))
 
-        for wrapMeth in sorted(self.wrapMeth2callCount.keys()):
-            logging.debug("WrapMeth: %-30s %6d" % (wrapMeth,
-                                                   self.wrapMeth2callCount[wrapMeth]))
+        for (wrapMeth, count) in sorted(zip(self.wrapMethNames, self.wrapCallCounts)):
+            logging.debug("WrapMeth: %-30s %6d" % (wrapMeth, count))
 
     def dumpReqAnsErrSituation(self):
         logging.debug("%s\t%s\t%s\t%s" % ("ReqId", "#Req", "#Ans", "#Err"))
@@ -355,7 +1054,8 @@ class TestApp(TestWrapper, TestClient):
     @iswrapper
     # ! [connectack]
     def connectAck(self):
-        if self.async_python35:
+        # a synchronous connect() has already sent startApi
+        if self.asynchronous:
             self.startApi()
 
     # ! [connectack]
@@ -367,6 +1067,7 @@ class TestApp(TestWrapper, TestClient):
 
         logging.debug("setting nextValidOrderId: %d", orderId)
         self.nextValidOrderId = orderId
+        self.reqFutures.resolve(NO_VALID_ID, 'nextValidId', orderId)
         # ! [nextvalidid]
 
         # we can start now
@@ -429,10 +1130,19 @@ class TestApp(TestWrapper, TestClient):
         self.bulletins_cancel()
         print("Executing cancels ... finished")
 
+    @property
+    def nextValidOrderId(self):
+        return self.orderIdAlloc.next
+
+    @nextValidOrderId.setter
+    def nextValidOrderId(self, orderId):
+        self.orderIdAlloc.resync(orderId)
+
     def nextOrderId(self):
-        oid = self.nextValidOrderId
-        self.nextValidOrderId += 1
-        return oid
+        return self.orderIdAlloc.take()
+
+    def nextReqId(self):
+        return self.reqIdAlloc.take()
 
     @iswrapper
     # ! [error]
@@ -440,6 +1150,19 @@ class TestApp(TestWrapper, TestClient):
         super().error(reqId, errorCode, errorString)
         print("Error. Id: ", reqId, " Code: ", errorCode, " Msg: ", errorString)
 
+        # only TERMINAL_ERRORS end a request, or ORDER_TERMINAL_ERRORS an order (ids below
+        # REQID_BASE), no further answers will come for it. Errors for NO_VALID_ID concern the
+        # connection (1100-1102, 504, ...), never a request.
+        terminal = self.TERMINAL_ERRORS if reqId >= self.REQID_BASE else self.ORDER_TERMINAL_ERRORS
+        if reqId != NO_VALID_ID and errorCode in terminal:
+            self.reqFutures.fail(reqId, errorCode, errorString)
+            if self.requestMgr is not None:
+                self.requestMgr.receivedError(reqId, errorCode)
+            if reqId in self.reqId2listener:
+                self.reqId2listener[reqId](('error', errorCode, errorString))
+            if errorCode == 101 and self.mktDataScheduler is not None:
+                self.mktDataScheduler.onLimit(reqId)
+
     # ! [error] self.reqId2nErr[reqId] += 1
 
     @iswrapper
@@ -490,6 +1213,8 @@ class TestApp(TestWrapper, TestClient):
               ", PermId: ", permId, ", ParentId: ", parentId, ", LastFillPrice: ",
               lastFillPrice, ", ClientId: ", clientId, ", WhyHeld: ",
               whyHeld, ", MktCapPrice: ", mktCapPrice)
+        self.orderId2filled[orderId] = filled
+        self.reqFutures.resolve(orderId, ('orderStatus', status), status)
 
     # ! [orderstatus]
 
@@ -847,7 +1572,9 @@ class TestApp(TestWrapper, TestClient):
     # ! [ticksize]
     def tickSize(self, reqId: TickerId, tickType: TickType, size: int):
         super().tickSize(reqId, tickType, size)
-        print("Tick Size. Ticker Id:", reqId, "tickType:", tickType, "Size:", size)
+        cbLog["tickSize"].debug("Tick Size. Ticker Id: %d tickType: %d Size: %s", reqId, tickType, size)
+        if self.requestMgr is not None:
+            self.requestMgr.receivedMsg(reqId, ('tickSize', tickType))
 
     # ! [ticksize]
 
@@ -855,7 +1582,7 @@ class TestApp(TestWrapper, TestClient):
     # ! [tickgeneric]
     def tickGeneric(self, reqId: TickerId, tickType: TickType, value: float):
         super().tickGeneric(reqId, tickType, value)
-        print("Tick Generic. Ticker Id:", reqId, "tickType:", tickType, "Value:", value)
+        cbLog["tickGeneric"].debug("Tick Generic. Ticker Id: %d tickType: %d Value: %s", reqId, tickType, value)
 
     # ! [tickgeneric]
 
@@ -863,7 +1590,7 @@ class TestApp(TestWrapper, TestClient):
     # ! [tickstring]
     def tickString(self, reqId: TickerId, tickType: TickType, value: str):
         super().tickString(reqId, tickType, value)
-        print("Tick string. Ticker Id:", reqId, "Type:", tickType, "Value:", value)
+        cbLog["tickString"].debug("Tick string. Ticker Id: %d Type: %d Value: %s", reqId, tickType, value)
 
     # ! [tickstring]
 
@@ -1113,23 +1840,23 @@ class TestApp(TestWrapper, TestClient):
     @iswrapper
     # ! [headTimestamp]
     def headTimestamp(self, reqId: int, headTimestamp: str):
-        print("HeadTimestamp: ", reqId, " ", headTimestamp)
+        cbLog["headTimestamp"].debug("HeadTimestamp: %d %s", reqId, headTimestamp)
 
     # ! [headTimestamp]
 
     @iswrapper
     # ! [histogramData]
     def histogramData(self, reqId: int, items: HistogramDataList):
-        print("HistogramData: ", reqId, " ", items)
+        cbLog["histogramData"].debug("HistogramData: %d %s", reqId, items)
 
     # ! [histogramData]
 
     @iswrapper
     # ! [historicaldata]
     def historicalData(self, reqId: int, bar: BarData):
-        print("HistoricalData. ", reqId, " Date:", bar.date, "Open:", bar.open,
-              "High:", bar.high, "Low:", bar.low, "Close:", bar.close, "Volume:", bar.volume,
-              "Count:", bar.barCount, "WAP:", bar.average)
+        cbLog["historicalData"].debug("HistoricalData. %d Date: %s Open: %s High: %s Low: %s Close: %s Volume: %s "
+                                      "Count: %s WAP: %s", reqId, bar.date, bar.open, bar.high, bar.low, bar.close,
+                                      bar.volume, bar.barCount, bar.average)
 
     # ! [historicaldata]
 
@@ -1137,25 +1864,26 @@ class TestApp(TestWrapper, TestClient):
     # ! [historicaldataend]
     def historicalDataEnd(self, reqId: int, start: str, end: str):
         super().historicalDataEnd(reqId, start, end)
-        print("HistoricalDataEnd ", reqId, "from", start, "to", end)
+        cbLog["historicalDataEnd"].debug("HistoricalDataEnd %d from %s to %s", reqId, start, end)
 
     # ! [historicaldataend]
 
     @iswrapper
     # ! [historicalDataUpdate]
     def historicalDataUpdate(self, reqId: int, bar: BarData):
-        print("HistoricalDataUpdate. ", reqId, " Date:", bar.date, "Open:", bar.open,
-              "High:", bar.high, "Low:", bar.low, "Close:", bar.close, "Volume:", bar.volume,
-              "Count:", bar.barCount, "WAP:", bar.average)
+        cbLog["historicalDataUpdate"].debug("HistoricalDataUpdate. %d Date: %s Open: %s High: %s Low: %s Close: %s "
+                                            "Volume: %s Count: %s WAP: %s", reqId, bar.date, bar.open, bar.high,
+                                            bar.low, bar.close, bar.volume, bar.barCount, bar.average)
 
     # ! [historicalDataUpdate]
 
     @iswrapper
     # ! [historicalticks]
     def historicalTicks(self, reqId: int, ticks: ListOfHistoricalTick, done: bool):
-        for tick in ticks:
-            print("Historical Tick. Req Id: ", reqId, ", time: ", tick.time,
-                  ", price: ", tick.price, ", size: ", tick.size)
+        if cbLog["historicalTicks"].isEnabledFor(logging.DEBUG):
+            for tick in ticks:
+                cbLog["historicalTicks"].debug("Historical Tick. Req Id: %d, time: %s, price: %s, size: %s",
+                                               reqId, tick.time, tick.price, tick.size)
 
     # ! [historicalticks]
 
@@ -1163,10 +1891,11 @@ class TestApp(TestWrapper, TestClient):
     # ! [historicalticksbidask]
     def historicalTicksBidAsk(self, reqId: int, ticks: ListOfHistoricalTickBidAsk,
                               done: bool):
-        for tick in ticks:
-            print("Historical Tick Bid/Ask. Req Id: ", reqId, ", time: ", tick.time,
-                  ", bid price: ", tick.priceBid, ", ask price: ", tick.priceAsk,
-                  ", bid size: ", tick.sizeBid, ", ask size: ", tick.sizeAsk)
+        if cbLog["historicalTicksBidAsk"].isEnabledFor(logging.DEBUG):
+            for tick in ticks:
+                cbLog["historicalTicksBidAsk"].debug(
+                    "Historical Tick Bid/Ask. Req Id: %d, time: %s, bid price: %s, ask price: %s, bid size: %s, "
+                    "ask size: %s", reqId, tick.time, tick.priceBid, tick.priceAsk, tick.sizeBid, tick.sizeAsk)
 
     # ! [historicalticksbidask]
 
@@ -1174,10 +1903,12 @@ class TestApp(TestWrapper, TestClient):
     # ! [historicaltickslast]
     def historicalTicksLast(self, reqId: int, ticks: ListOfHistoricalTickLast,
                             done: bool):
-        for tick in ticks:
-            print("Historical Tick Last. Req Id: ", reqId, ", time: ", tick.time,
-                  ", price: ", tick.price, ", size: ", tick.size, ", exchange: ", tick.exchange,
-                  ", special conditions:", tick.specialConditions)
+        if cbLog["historicalTicksLast"].isEnabledFor(logging.DEBUG):
+            for tick in ticks:
+                cbLog["historicalTicksLast"].debug(
+                    "Historical Tick Last. Req Id: %d, time: %s, price: %s, size: %s, exchange: %s, "
+                    "special conditions: %s", reqId, tick.time, tick.price, tick.size, tick.exchange,
+                    tick.specialConditions)
 
     # ! [historicaltickslast]
 
@@ -1907,13 +2638,78 @@ class TestApp(TestWrapper, TestClient):
         # ! [commissionreport]
 
 
+class AsyncTestApp(Object):
+    # asyncio front end for a connected TestApp: request methods are coroutines and streaming
+    # subscriptions are async iterators. Answers still arrive on the EReader thread and are handed
+    # to the event loop with call_soon_threadsafe, so any number of requests can be awaited
+    # concurrently from one loop thread. Use it from the loop thread only.
+    def __init__(self, app: TestApp):
+        self.app = app
+
+    async def connected(self, timeout=None):
+        return await asyncio.wait_for(asyncio.wrap_future(self.app.nextValidIdFuture), timeout)
+
+    async def contractDetails(self, contract: Contract, timeout=None):
+        reqId = self.app.nextReqId()
+        fut = self.app.reqFutures.expect(reqId, 'contractDetailsEnd')
+        self.app.reqContractDetails(reqId, contract)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(fut), timeout)
+        finally:
+            self.app.reqFutures.discard(reqId)
+
+    async def optionParams(self, symbol, conId, exchange="", secType="STK", timeout=None):
+        # list of (exchange, underlyingConId, tradingClass, multiplier, expirations, strikes)
+        reqId = self.app.nextReqId()
+        fut = self.app.reqFutures.expect(reqId, 'securityDefinitionOptionParameterEnd')
+        self.app.reqSecDefOptParams(reqId, symbol, exchange, secType, conId)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(fut), timeout)
+        finally:
+            self.app.reqFutures.discard(reqId)
+
+    async def greeksSnapshot(self, contract: Contract, timeout=None):
+        # first model computation (tick type 13) for the contract, market data cancelled after
+        reqId = self.app.nextReqId()
+        fut = self.app.reqFutures.expect(reqId, ('tickOptionComputation', 13))
+        self.app.reqMktData(reqId, contract, "", False, False, [])
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(fut), timeout)
+        finally:
+            self.app.reqFutures.discard(reqId)
+            self.app.cancelMktData(reqId)
+
+    async def streamTicks(self, contract: Contract, genericTickList=""):
+        # yields ('tickPrice', tickType, price) and ('tickOptionComputation', tickType, impliedVol,
+        # delta, optPrice, pvDividend, gamma, vega, theta, undPrice) until the consumer stops
+        # iterating; a terminal error for the subscription raises ReqError
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        reqId = self.app.nextReqId()
+        self.app.reqId2listener[reqId] = lambda event: loop.call_soon_threadsafe(queue.put_nowait, event)
+        self.app.reqMktData(reqId, contract, genericTickList, False, False, [])
+        try:
+            while True:
+                event = await queue.get()
+                if event[0] == 'error':
+                    raise ReqError(reqId, event[1], event[2])
+                yield event
+        finally:
+            del self.app.reqId2listener[reqId]
+            self.app.cancelMktData(reqId)
+
+
 # %%
-SetupLogger()
+logListener = SetupLogger()
 logging.debug("now is %s", datetime.datetime.now())
 logging.getLogger().setLevel(logging.INFO)
 # %%
-app = TestApp()  
+app = TestApp(recorder=CallbackRecorder(time.strftime("log/callbacks.%y%m%d_%H%M%S.bin")))
+app.contractCache = ContractCache()
+app.volSurface = VolSurface()
+app.traceRequests()
 app.gammascarping("ES", "GLOBEX", "FUT", 289128563)
+app.dumpLatencySituation()
 # app.reqSecDefOptParams(app.nextOrderId(), "IBM", "", "STK", 8314)
 
 # %%
@@ -1927,91 +2723,34 @@ import math
 
 from scipy.special import comb
 
-df = pd.DataFrame().from_dict(app.optionchain, 'columns')
-df.to_csv('C:\\ibop\\OC_ES20181031.csv',encoding='gbk',header=True,index=False)
-df['duration'] = (pd.to_datetime(df.expirations.map(str)) - pd.to_datetime('20181028'))
-
-df.duration = df.duration.map(lambda x: x.days)
-df['price'] = df.optPrice
-df = df.dropna(how='any', subset=['gamma', 'theta', 'delta', 'price', 'multiplier'])
-rawdata = df[
-    ['conId','delta', 'gamma', 'theta', 'right', 'duration', 'strikes', 'price', 'symbol','exchange']]
-
-datalist = []
-#%%
-for i in range(-15, 16):
-    mid_data = rawdata.copy(deep=True)
-    mid_data['delta'] = mid_data['delta'] * i
-    mid_data['gamma'] = mid_data['gamma'] * i
-    mid_data['theta'] = mid_data['theta'] * i
-    mid_data['parameter'] = i
-    datalist.append(mid_data)
-
-inputdata = pd.concat(datalist, axis=0)
-
-og = inputdata.gamma.values
-od = inputdata.delta.values
-ot = inputdata.theta.values
-
-
-def searchForAlpha(m):
-    return sum((m.x[i] * og[i - 1] + 10 * m.x[i] * ot[i - 1] for i in
-                m.I))  # -150*abs(3-sum((m.x[i] for i in m.I)))-10*abs(sum((m.x[i]*od[i-1]for i in m.I)))
-
-
-def threelegs_up(m):
-    return sum((m.x[i] for i in m.I)) <= 3
-
-
-def threelegs_down(m):
-    return sum((m.x[i] for i in m.I)) >= -3
-
-
-def deltaBound_up(m):
-    return sum((m.x[i] * od[i - 1] for i in m.I)) <= 0.1
-
-
-def deltaBound_down(m):
-    return sum((m.x[i] * od[i - 1] for i in m.I)) >= -0.1
-
-
-def thetaBound_up(m):
-    return sum((m.x[i] * ot[i - 1] for i in m.I)) <= 0
-
-
-def thetaBound_down(m):
-    return sum((m.x[i] * ot[i - 1] for i in m.I)) >= -5
+import portfolio
+from solvers import makeSolver
 
+# strikes TWS never sent model greeks for get local Black-76 greeks instead of being dropped below
+logging.info('local greeks for %d strikes', fillModelGreeks(app.optionchain, app.optionchain_underlyingPrice))
+df = app.optionchain.to_pandas()
+df.to_csv('C:\\ibop\\OC_ES20181031.csv',encoding='gbk',header=True,index=False)
+# python pareto.py C:\ibop\OC_ES20181031.csv sweeps the delta/theta bounds and theta weight below
+df = portfolio.prepareChain(df, '20181028')
+chain = df[portfolio.RAW_COLUMNS]
+rawdata = portfolio.pruneChain(chain, thetaWeight=10.)
 
 # %%
-BinaryIdx = {i for i in range(0, inputdata.shape[0])}
-
-model = ConcreteModel()
-
-model.I = Set(initialize=RangeSet(inputdata.shape[0]))
-
-model.x = Var(model.I, domain=Binary)
-
-model.TotalProfit = Objective(rule=searchForAlpha, sense=maximize)
-
-model.legbound_up = Constraint(rule=threelegs_up)
-model.legbound_down = Constraint(rule=threelegs_down)
-
-model.deltabound_up = Constraint(rule=deltaBound_up)
-model.deltabound_down = Constraint(rule=deltaBound_down)
-
-model.thetabound_up = Constraint(rule=thetaBound_up)
-model.thetabound_down = Constraint(rule=thetaBound_down)
-
-solver = SolverFactory("cplex", executable='C:\\cplex\\CPLEX_Optimizer\\cplex\\bin\\x86_win32\\cplex.exe', tee=True)
-# solver = SolverFactory("ipopt",executable='C:\\Ipopt\\bin\\ipopt.exe',solver_io = 'nl')
-results = solver.solve(model, tee=True)
-
-x_values = []
-for i in range(0, inputdata.shape[0]):
-    x_values.append(value(model.x[i + 1]))
-inputdata['selected'] = x_values
-re_df = inputdata[inputdata.selected > 0.9]
+model = portfolio.QuantityMILP(rawdata, thetaWeight=10.)
+logging.info('pre-solve: %d of %d options cannot be in the optimum, %d model columns cut',
+             len(chain) - len(rawdata), len(chain), (len(chain) - len(rawdata)) * model.A.shape[1] // model.n)
+logging.info('portfolio model: %d variables, %d rows, %d nonzeros built in %.1f ms', model.A.shape[1],
+             model.A.shape[0], model.A.nnz, model.buildTime * 1e3)
+# HiGHS in process (scipy's milp when highspy is missing); makeSolver("pyomo:cbc") etc. for another backend
+solver = makeSolver(timeLimit=60, mipGap=1e-4, verbose=True)
+results = model.solve(solver)
+logging.info('portfolio model: %s %s in %.2fs, objective %.6f gap %.2g', solver.name, results.message,
+             results.solveTime, model.objective, results.gap)
+# the next best combos on other legs, for when the best one does not fill
+(ranking, candidates) = portfolio.topPortfolios(model, 5, solver)
+logging.info('top portfolios:\n%s', ranking.to_string())
+
+re_df = model.selected()
 #%%
 print(df[df.conId.isin(re_df.conId.values)][['delta', 'gamma', 'theta', 'expirations']])
 
@@ -2027,36 +2766,19 @@ print('单独option的Alpha：')
 print((df.gamma/df.theta.abs()).sort_values(ascending=False)[:20])
 
 #%%
-contract = Contract()
-contract.symbol = re_df.symbol.unique()[0]
-contract.secType = "BAG"
-contract.currency = "USD"
-contract.exchange = re_df.exchange.unique()[0]   
-contract.comboLegs = []
-
-comboprice = 0
-
-for arow in enumerate(re_df.iterrows()):
-    acontract = arow[1][1]
-	       
-    newComboLeg = ComboLeg()
-    newComboLeg.conId = acontract.conId
-    newComboLeg.ratio = abs(acontract.parameter)
-    newComboLeg.exchange = acontract.exchange
-    if acontract.parameter>0:
-        newComboLeg.action = 'BUY'
-    else:
-        newComboLeg.action = 'SELL'
-		
-    contract.comboLegs.append(newComboLeg)
-    comboprice += acontract.parameter*acontract.price
-
-order = Order()
-order.action = 'BUY'
-order.orderType = "LMT"
-order.totalQuantity = 10
-order.lmtPrice = float(format(comboprice, '0.1f'))
-        
-app.placeOrder(app.nextOrderId(), contract,order)
+filled = app.placeFirstFilled([portfolio.comboOrder(rows) for rows in candidates])
+logging.info('combo order: %s', filled)
+# %%
+# live: keep streaming the chain and re-solve the portfolio in place as its greeks move, over the
+# unpruned chain since the pruning only holds for the greeks it saw
+# app.portfolioTracker = portfolio.PortfolioTracker(
+#     portfolio.QuantityMILP(chain), app.optionchain, makeSolver(timeLimit=0.5, mipGap=1e-3),
+#     onSolution=lambda re_df: logging.info('portfolio: %s', re_df[['conId', 'parameter']].values.tolist()))
+# app.keepChainFresh()
+# app.portfolioTracker.start()
+# time.sleep(600)
+# app.portfolioTracker.stop()
+# app.mktDataScheduler.stop()
 # %%
 app.disconnect()
+app.recorder.close()
@@ -0,0 +1,374 @@
+import collections
+import datetime
+import heapq
+import logging
+import random
+import socket
+import struct
+import time
+from threading import Thread, Lock, Condition, Event
+
+import numpy as np
+from ibapi.message import IN, OUT
+from ibapi.server_versions import (MIN_SERVER_VER_ORDER_CONTAINER, MIN_SERVER_VER_PRICE_BASED_VOLATILITY,
+                                   MIN_SERVER_VER_STOCK_TYPE)
+
+from pricing import black76, yearsToExpiry
+
+# message layouts below are those of server version 157, the maximum of the ibapi 9.81 client the
+# script is written against (9.81.1.post1). Clients announcing a lower maximum get their own
+# version back; contract details and option computations follow it, everything else keeps the
+# 157 layouts, so keep clients at 9.73 (server version 148) or later.
+SERVER_VERSION = 157
+
+OPTION_SECTYPES = ("OPT", "FOP")
+
+
+def makeMsg(*fields):
+    text = "".join("%s\0" % (int(field) if isinstance(field, bool) else field) for field in fields)
+    payload = text.encode("ascii")
+    return struct.pack("!I", len(payload)) + payload
+
+
+class SyntheticChain:
+    # one underlying and its listed options: weekly expiries starting next Friday and nStrikes
+    # strikes strikeStep apart centred on undPrice, both rights. Option values come from black76
+    # on a quadratic smile in log-moneyness.
+    def __init__(self, symbol="ES", undConId=289128563, exchange="GLOBEX", undSecType="FUT", multiplier="50",
+                 undPrice=2800., strikeStep=5., nStrikes=200, nExpiries=12, atmVol=0.2, skew=-0.1,
+                 curvature=0.5, today=None):
+        self.symbol = symbol
+        self.undConId = undConId
+        self.exchange = exchange
+        self.undSecType = undSecType
+        self.multiplier = multiplier
+        self.undPrice = undPrice
+        self.atmVol = atmVol
+        self.skew = skew
+        self.curvature = curvature
+
+        today = today or datetime.date.today()
+        friday = today + datetime.timedelta(days=(4 - today.weekday()) % 7 or 7)
+        self.expirations = [(friday + datetime.timedelta(weeks=i)).strftime("%Y%m%d") for i in range(nExpiries)]
+        self.strikes = undPrice + strikeStep * (np.arange(nStrikes) - nStrikes // 2)
+
+        # (expiry, strike, right) -> conId, and back
+        self.key2conId = {}
+        self.conId2key = {}
+        conId = undConId + 1
+        for expiry in self.expirations:
+            for strike in self.strikes:
+                for right in ("C", "P"):
+                    self.key2conId[(expiry, float(strike), right)] = conId
+                    self.conId2key[conId] = (expiry, float(strike), right)
+                    conId += 1
+
+    def find(self, conId, symbol, secType, expiry, strike, right):
+        # option keys matching a request, fields left empty match anything
+        if conId:
+            return [self.conId2key[conId]] if conId in self.conId2key else []
+        if symbol != self.symbol or secType not in OPTION_SECTYPES:
+            return []
+        if expiry and strike and right:
+            key = (expiry, float(strike), right[0])
+            return [key] if key in self.key2conId else []
+        return [key for key in self.key2conId
+                if (not expiry or key[0] == expiry) and (not strike or key[1] == float(strike))
+                and (not right or key[2] == right[0])]
+
+    def isUnderlying(self, conId, symbol, secType):
+        return conId == self.undConId or (not conId and symbol == self.symbol and secType not in OPTION_SECTYPES)
+
+    def model(self, key, undPrice):
+        # (impliedVol, delta, optPrice, gamma, vega, theta) of one option at undPrice
+        (expiry, strike, right) = key
+        T = float(yearsToExpiry([expiry])[0])
+        k = np.log(strike / undPrice)
+        vol = max(self.atmVol + self.skew * k + self.curvature * k * k, 0.01)
+        g = black76(undPrice, strike, max(T, 1e-6), vol, 0., right == "C")
+        return (vol, float(g["delta"]), float(g["price"]), float(g["gamma"]), float(g["vega"]), float(g["theta"]))
+
+
+class LocalTws:
+    # a stand-in for TWS on a local socket, speaking enough of the API protocol for the option chain
+    # and order code: the handshake and startApi, reqIds, reqSecDefOptParams, reqContractDetails,
+    # reqMktData/cancelMktData with synthetic tickPrice/tickSize/tickOptionComputation streams and
+    # snapshots, and placeOrder answered with orderStatus (no openOrder). Other requests are ignored.
+    #
+    # tickRate is tick rounds per second per subscription and burst the rounds sent back to back
+    # each time; latency (plus up to jitter) delays every answer to a request. Clients sending more
+    # than maxMsgPerSec messages in one second get error 100 for the excess messages, which are
+    # dropped, and subscriptions beyond maxLines get error 101, as TWS does.
+    def __init__(self, chain=None, host="127.0.0.1", port=0, tickRate=4., burst=1, latency=0., jitter=0.,
+                 maxMsgPerSec=50, maxLines=100, seed=0):
+        self.chain = chain or SyntheticChain()
+        self.host = host
+        self.port = port
+        self.tickRate = tickRate
+        self.burst = burst
+        self.latency = latency
+        self.jitter = jitter
+        self.maxMsgPerSec = maxMsgPerSec
+        self.maxLines = maxLines
+        self.random = random.Random(seed)
+        self.sock = None
+        self.sessions = []
+        self.stopped = Event()
+
+    def start(self):
+        # listens in the background, returns the bound port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        Thread(target=self.acceptLoop, name="localtws", daemon=True).start()
+        return self.port
+
+    def acceptLoop(self):
+        while not self.stopped.is_set():
+            try:
+                (conn, addr) = self.sock.accept()
+            except OSError:
+                return
+            session = TwsSession(self, conn)
+            self.sessions.append(session)
+            session.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sock.close()
+        for session in self.sessions:
+            session.close()
+
+    def delay(self):
+        return self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.)
+
+
+class TwsSession:
+    # one client connection: a reader thread handling requests, a ticker thread streaming market
+    # data and a writer thread sending everything in due-time order
+    def __init__(self, server, conn):
+        self.server = server
+        self.chain = server.chain
+        self.conn = conn
+        self.serverVersion = SERVER_VERSION
+        self.undPrice = self.chain.undPrice
+        self.nextOrderId = 1
+        self.lock = Lock()
+        # reqId -> option key, or None for the underlying
+        self.subscriptions = {}
+        self.received = collections.deque()
+        self.outbox = []
+        self.outboxCond = Condition()
+        self.seq = 0
+        self.closed = Event()
+        self.stats = collections.defaultdict(int)
+
+    def start(self):
+        Thread(target=self.readLoop, name="localtws-read", daemon=True).start()
+        Thread(target=self.writeLoop, name="localtws-write", daemon=True).start()
+        Thread(target=self.tickLoop, name="localtws-tick", daemon=True).start()
+
+    def close(self):
+        self.closed.set()
+        with self.outboxCond:
+            self.outboxCond.notify()
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+
+    def send(self, *fields, delay=0.):
+        msg = makeMsg(*fields)
+        with self.outboxCond:
+            self.seq += 1
+            heapq.heappush(self.outbox, (time.time() + delay, self.seq, msg))
+            self.outboxCond.notify()
+
+    def answer(self, *fields):
+        self.send(*fields, delay=self.server.delay())
+
+    def error(self, reqId, code, text):
+        self.answer(IN.ERR_MSG, 2, reqId, code, text)
+
+    def writeLoop(self):
+        while not self.closed.is_set():
+            with self.outboxCond:
+                while not self.outbox or self.outbox[0][0] > time.time():
+                    if self.closed.is_set():
+                        return
+                    self.outboxCond.wait(self.outbox[0][0] - time.time() if self.outbox else None)
+                (due, seq, msg) = heapq.heappop(self.outbox)
+            try:
+                self.conn.sendall(msg)
+            except OSError:
+                self.close()
+                return
+            self.stats["sent"] += 1
+
+    def recvExactly(self, size):
+        buf = b""
+        while len(buf) < size:
+            chunk = self.conn.recv(size - len(buf))
+            if not chunk:
+                raise EOFError()
+            buf += chunk
+        return buf
+
+    def recvMsg(self):
+        (size,) = struct.unpack("!I", self.recvExactly(4))
+        return self.recvExactly(size).decode("ascii").split("\0")[:-1]
+
+    def readLoop(self):
+        try:
+            # "API\0" and the supported version range "vMIN..MAX", not null terminated
+            if self.recvExactly(4) != b"API\0":
+                raise EOFError()
+            (size,) = struct.unpack("!I", self.recvExactly(4))
+            versions = self.recvExactly(size).decode("ascii")
+            clientMax = int(versions.split()[0].split("..")[-1].lstrip("v"))
+            self.serverVersion = min(clientMax, SERVER_VERSION)
+            self.send(self.serverVersion, time.strftime("%Y%m%d %H:%M:%S") + " EST")
+            while not self.closed.is_set():
+                fields = self.recvMsg()
+                if fields:
+                    self.handle(fields)
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.close()
+
+    def reqIdOf(self, msgId, fields):
+        if msgId in (OUT.REQ_MKT_DATA, OUT.CANCEL_MKT_DATA, OUT.REQ_CONTRACT_DATA):
+            return int(fields[2])
+        if msgId == OUT.REQ_SEC_DEF_OPT_PARAMS:
+            return int(fields[1])
+        return -1
+
+    def handle(self, fields):
+        msgId = int(fields[0])
+        now = time.time()
+        self.received.append(now)
+        while self.received[0] < now - 1.:
+            self.received.popleft()
+        if len(self.received) > self.server.maxMsgPerSec:
+            self.stats["paced"] += 1
+            self.error(self.reqIdOf(msgId, fields), 100, "Max rate of messages per second has been exceeded:"
+                       "max=%d rec=%d" % (self.server.maxMsgPerSec, len(self.received)))
+            return
+        self.stats["received"] += 1
+
+        if msgId == OUT.START_API:
+            self.answer(IN.NEXT_VALID_ID, 1, self.nextOrderId)
+            self.answer(IN.MANAGED_ACCTS, 1, "DU0000001")
+        elif msgId == OUT.REQ_IDS:
+            self.answer(IN.NEXT_VALID_ID, 1, self.nextOrderId)
+        elif msgId == OUT.REQ_SEC_DEF_OPT_PARAMS:
+            self.reqSecDefOptParams(int(fields[1]), fields[2], int(fields[5] or 0))
+        elif msgId == OUT.REQ_CONTRACT_DATA:
+            self.reqContractDetails(int(fields[2]), int(fields[3] or 0), fields[4], fields[5], fields[6],
+                                    float(fields[7] or 0), fields[8])
+        elif msgId == OUT.REQ_MKT_DATA:
+            self.reqMktData(fields)
+        elif msgId == OUT.CANCEL_MKT_DATA:
+            with self.lock:
+                self.subscriptions.pop(int(fields[2]), None)
+        elif msgId == OUT.PLACE_ORDER:
+            self.placeOrder(fields)
+        else:
+            logging.debug("localtws: ignoring message %d", msgId)
+
+    def reqSecDefOptParams(self, reqId, symbol, undConId):
+        chain = self.chain
+        if symbol == chain.symbol or undConId == chain.undConId:
+            self.answer(*([IN.SECURITY_DEFINITION_OPTION_PARAMETER, reqId, chain.exchange, chain.undConId,
+                           chain.symbol, chain.multiplier, len(chain.expirations)] + chain.expirations +
+                          [len(chain.strikes)] + [float(strike) for strike in chain.strikes]))
+        self.answer(IN.SECURITY_DEFINITION_OPTION_PARAMETER_END, reqId)
+
+    def reqContractDetails(self, reqId, conId, symbol, secType, expiry, strike, right):
+        chain = self.chain
+        keys = chain.find(conId, symbol, secType, expiry, strike, right)
+        if not keys:
+            self.error(reqId, 200, "No security definition has been found for the request")
+            return
+        optSecType = secType if secType in OPTION_SECTYPES else ("FOP" if chain.undSecType == "FUT" else "OPT")
+        for key in keys:
+            (expiry, strike, right) = key
+            fields = [IN.CONTRACT_DATA, 8, reqId, chain.symbol, optSecType, expiry, strike, right, chain.exchange,
+                      "USD", "%s %s %s%g" % (chain.symbol, expiry, right, strike), chain.symbol, chain.symbol,
+                      chain.key2conId[key], 0.05, 1, chain.multiplier, "LMT,MKT", chain.exchange, 1,
+                      chain.undConId, chain.symbol, "", expiry[:6], "", "", "", "US/Central", "", "", "", 0, 0,
+                      0, chain.symbol, chain.undSecType, "", expiry]
+            if self.serverVersion >= MIN_SERVER_VER_STOCK_TYPE:
+                fields.append("")
+            self.answer(*fields)
+        self.answer(IN.CONTRACT_DATA_END, 1, reqId)
+
+    def reqMktData(self, fields):
+        # reqId, conId, symbol, secType, expiry, strike, right, ..., tradingClass, deltaNeutral flag,
+        # genericTickList, snapshot for a non-BAG contract
+        reqId = int(fields[2])
+        (conId, symbol, secType, expiry, strike, right) = (int(fields[3] or 0), fields[4], fields[5], fields[6],
+                                                           float(fields[7] or 0), fields[8])
+        snapshot = secType != "BAG" and fields[15] == "0" and fields[17] == "1"
+        if self.chain.isUnderlying(conId, symbol, secType):
+            key = None
+        else:
+            keys = self.chain.find(conId, symbol, secType, expiry, strike, right)
+            if len(keys) != 1:
+                self.error(reqId, 200, "No security definition has been found for the request")
+                return
+            key = keys[0]
+        if snapshot:
+            self.sendTicks(reqId, key, self.server.delay())
+            self.answer(IN.TICK_SNAPSHOT_END, 1, reqId)
+            return
+        with self.lock:
+            if len(self.subscriptions) >= self.server.maxLines:
+                self.error(reqId, 101, "Max number of tickers has been reached")
+                return
+            self.subscriptions[reqId] = key
+        if key is None:
+            self.answer(IN.TICK_PRICE, 6, reqId, 9, self.undPrice, 0, 0)
+        self.sendTicks(reqId, key, self.server.delay())
+
+    def sendTicks(self, reqId, key, delay=0.):
+        und = self.undPrice
+        if key is None:
+            (price, spread) = (und, 0.25)
+        else:
+            (vol, delta, price, gamma, vega, theta) = self.chain.model(key, und)
+            spread = max(0.05, round(0.02 * price, 2))
+            if self.serverVersion >= MIN_SERVER_VER_PRICE_BASED_VOLATILITY:
+                # no version field, the tick attribute 0 (return based) after the tick type
+                self.send(IN.TICK_OPTION_COMPUTATION, reqId, 13, 0, vol, delta, price, 0., gamma, vega, theta, und,
+                          delay=delay)
+            else:
+                self.send(IN.TICK_OPTION_COMPUTATION, 6, reqId, 13, vol, delta, price, 0., gamma, vega, theta, und,
+                          delay=delay)
+        self.send(IN.TICK_PRICE, 6, reqId, 1, round(price - spread / 2, 2), 10, 1, delay=delay)
+        self.send(IN.TICK_PRICE, 6, reqId, 2, round(price + spread / 2, 2), 10, 1, delay=delay)
+        self.send(IN.TICK_PRICE, 6, reqId, 4, round(price, 2), 1, 0, delay=delay)
+
+    def tickLoop(self):
+        period = 1. / self.server.tickRate
+        while not self.closed.wait(period):
+            # the underlying follows a random walk with about 20% annual volatility
+            self.undPrice *= np.exp(0.2 * np.sqrt(period / (252 * 6.5 * 3600)) * self.server.random.gauss(0, 1))
+            with self.lock:
+                subscriptions = list(self.subscriptions.items())
+            for _ in range(self.server.burst):
+                for (reqId, key) in subscriptions:
+                    self.sendTicks(reqId, key)
+
+    def placeOrder(self, fields):
+        # orderId, conId, 10 contract fields, tradingClass, secIdType, secId, action, totalQuantity
+        base = 1 if self.serverVersion >= MIN_SERVER_VER_ORDER_CONTAINER else 2
+        orderId = int(fields[base])
+        quantity = float(fields[base + 16] or 0)
+        self.nextOrderId = max(self.nextOrderId, orderId + 1)
+        permId = 1000000 + orderId
+        self.answer(IN.ORDER_STATUS, orderId, "Submitted", 0., quantity, 0., permId, 0, 0., 0, "", 0.)
+        self.answer(IN.ORDER_STATUS, orderId, "Filled", quantity, 0., 0., permId, 0, 0., 0, "", 0.)
@@ -0,0 +1,184 @@
+import collections
+import datetime
+import os.path
+import sqlite3
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+
+class ContractCache:
+    # conId, multiplier and exchange of a listed option never change, so contracts resolved once
+    # through reqContractDetails are kept in sqlite keyed by (symbol, secType, expiry, strike, right,
+    # exchange, tradingClass) and dropped once they expire.
+    def __init__(self, path="cache/contracts.sqlite"):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.lock = Lock()
+        # filled from the EReader thread, read from the requesting thread
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # caches written before exchange and tradingClass were part of the key may hold one class's
+        # conIds under another's strikes, they are dropped
+        primaryKey = [row[1] for row in self.conn.execute("PRAGMA table_info(contracts)") if row[5]]
+        if primaryKey and "tradingClass" not in primaryKey:
+            self.conn.execute("DROP TABLE contracts")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS contracts ("
+                          "symbol TEXT, secType TEXT, expiry TEXT, strike REAL, right TEXT, "
+                          "conId INTEGER, multiplier TEXT, exchange TEXT, tradingClass TEXT, "
+                          "PRIMARY KEY (symbol, secType, expiry, strike, right, exchange, tradingClass))")
+        self.evictExpired()
+
+    def get(self, symbol, secType, expiry, strike, right, exchange, tradingClass=None):
+        # (conId, multiplier, exchange, tradingClass) or None. Without a tradingClass the contract is
+        # only found when a single class is cached for it, as reqContractDetails would then also
+        # return a single contract.
+        with self.lock:
+            rows = self.conn.execute("SELECT conId, multiplier, exchange, tradingClass FROM contracts "
+                                     "WHERE symbol=? AND secType=? AND expiry=? AND strike=? AND right=? "
+                                     "AND exchange=? AND (? IS NULL OR tradingClass=?)",
+                                     (symbol, secType, expiry, float(strike), right, exchange, tradingClass,
+                                      tradingClass)).fetchall()
+        return rows[0] if len(rows) == 1 else None
+
+    def put(self, contract):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO contracts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              (contract.symbol, contract.secType, contract.lastTradeDateOrContractMonth,
+                               float(contract.strike), contract.right, contract.conId, contract.multiplier,
+                               contract.exchange, contract.tradingClass))
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+
+    def evictExpired(self, today=None):
+        # expiries are YYYYMMDD, or YYYYMM for contract months which stay alive until the month ends
+        today = today or datetime.date.today().strftime("%Y%m%d")
+        with self.lock:
+            n = self.conn.execute("DELETE FROM contracts WHERE (length(expiry) = 8 AND expiry < ?) "
+                                  "OR (length(expiry) = 6 AND expiry < ?)", (today, today[:6])).rowcount
+            self.conn.commit()
+        return n
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class OptionParamIndex:
+    # securityDefinitionOptionParameter sends every expiration and strike of a trading class; keep
+    # them per (exchange, tradingClass, multiplier) as sorted unique arrays so windows around a date
+    # or the underlying price are binary searches. Expirations are YYYYMMDD strings.
+    def __init__(self):
+        self.rows = collections.defaultdict(lambda: (set(), set()))
+        self.classes = {}
+        self.expirations = np.array([], dtype="U8")
+        self.strikes = np.array([], dtype=float)
+
+    def add(self, exchange, tradingClass, multiplier, expirations, strikes):
+        (exps, stks) = self.rows[(exchange, tradingClass, multiplier)]
+        exps.update(expirations)
+        stks.update(strikes)
+
+    def build(self):
+        for key, (exps, stks) in self.rows.items():
+            self.classes[key] = (np.array(sorted(exps), dtype="U8"), np.array(sorted(stks), dtype=float))
+        self.rows.clear()
+        if self.classes:
+            self.expirations = np.unique(np.concatenate([exps for (exps, stks) in self.classes.values()]))
+            self.strikes = np.unique(np.concatenate([stks for (exps, stks) in self.classes.values()]))
+
+    def keys(self, tradingClass=None):
+        return [key for key in self.classes if tradingClass is None or key[1] == tradingClass]
+
+    def classKey(self, tradingClass, exchange=None):
+        # the key of one trading class: the one on `exchange` when the class is listed there, else
+        # the first in sorted order so a class listed on several exchanges always resolves the same
+        keys = sorted(self.keys(tradingClass))
+        if not keys:
+            raise ValueError("trading class %r not in the option parameters, known keys: %s"
+                             % (tradingClass, sorted(self.classes)))
+        return next((key for key in keys if key[0] == exchange), keys[0])
+
+    def arrays(self, key=None):
+        # expirations and strikes of one (exchange, tradingClass, multiplier), or of all classes
+        return self.classes[key] if key is not None else (self.expirations, self.strikes)
+
+    def expiryWindow(self, first, last, key=None):
+        # expirations in [first, last)
+        exps = self.arrays(key)[0]
+        return exps[np.searchsorted(exps, first):np.searchsorted(exps, last)]
+
+    def strikeWindow(self, price, nBelow, nAbove, key=None):
+        # nBelow strikes under price and nAbove at or over it
+        stks = self.arrays(key)[1]
+        pos = np.searchsorted(stks, price)
+        return stks[max(pos - nBelow, 0):min(pos + nAbove, len(stks))]
+
+
+class OptionChainStore:
+    # one preallocated array per field plus a reqId -> row map, written in place by the tick and
+    # contract details callbacks. Rows are only appended from the requesting thread; reserve() the
+    # expected size before sending requests so the callbacks never race with a reallocation.
+    FIELDS = collections.OrderedDict([
+        ("symbol", object), ("right", object), ("multiplier", float), ("expirations", object),
+        ("strikes", float), ("gamma", float), ("conId", np.int64), ("exchange", object),
+        ("theta", float), ("delta", float), ("vega", float), ("undPrice", float),
+        ("impliedVol", float), ("optPrice", float), ("bid", float), ("ask", float)])
+
+    def __init__(self, capacity=256):
+        self.n = 0
+        self.reqId2row = {}
+        self.reqIds = np.zeros(capacity, dtype=np.int64)
+        self.cols = {}
+        for (name, dtype) in self.FIELDS.items():
+            self.cols[name] = self.emptyColumn(dtype, capacity)
+
+    @staticmethod
+    def emptyColumn(dtype, size):
+        if dtype is float:
+            return np.full(size, np.nan)
+        return np.zeros(size, dtype=dtype) if dtype is not object else np.full(size, None, dtype=object)
+
+    def reserve(self, capacity):
+        if capacity <= len(self.reqIds):
+            return
+        self.reqIds = np.concatenate([self.reqIds, np.zeros(capacity - len(self.reqIds), dtype=np.int64)])
+        for (name, dtype) in self.FIELDS.items():
+            col = self.cols[name]
+            self.cols[name] = np.concatenate([col, self.emptyColumn(dtype, capacity - len(col))])
+
+    def addRow(self, reqId, **values):
+        if self.n == len(self.reqIds):
+            self.reserve(max(1, 2 * self.n))
+        row = self.n
+        self.reqIds[row] = reqId
+        for (name, value) in values.items():
+            self.cols[name][row] = value
+        self.reqId2row[reqId] = row
+        self.n += 1
+        return row
+
+    def set(self, reqId, **values):
+        row = self.reqId2row[reqId]
+        for (name, value) in values.items():
+            self.cols[name][row] = value
+
+    def __contains__(self, reqId):
+        return reqId in self.reqId2row
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, name):
+        # view of the filled rows, no copy
+        return self.cols[name][:self.n]
+
+    def to_pandas(self):
+        return pd.DataFrame({name: self[name] for name in self.FIELDS},
+                            index=pd.Index(self.reqIds[:self.n], name="reqId"), copy=False)
+
+    def to_arrow(self):
+        import pyarrow as pa
+        return pa.table({name: pa.array(self[name]) for name in self.FIELDS})
@@ -0,0 +1,135 @@
+import argparse
+import itertools
+import multiprocessing
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import portfolio
+from solvers import makeSolver
+
+# solves QuantityMILP over a grid of (delta bound, theta bounds, theta weight) settings in a process
+# pool and marks the Pareto frontier of the resulting portfolios: most gamma, least theta decay, least
+# |delta|. The chain's greeks go to the workers once, through shared memory; each worker keeps one
+# model and one solver and moves through its settings changing bounds and costs in place, warm
+# started from its previous portfolio.
+#
+#   python pareto.py chain.csv --delta 0.05,0.1,0.2 --theta=-10:0,-5:0,-2:0 --weight 5,10,20
+#
+# where chain.csv is the chain the script writes after gammascarping.
+
+GREEKS = ['delta', 'gamma', 'theta']
+
+# per worker process
+workerModel = None
+workerSolver = None
+
+
+def initWorker(shmName, n, solverSpec, timeLimit, mipGap, maxQuantity, maxLegs):
+    global workerModel, workerSolver
+    # the model keeps its own arrays, so the greeks are copied out and the block closed right away.
+    # Pool workers share the parent's resource tracker, which unlinks the block only if the parent
+    # does not
+    shm = shared_memory.SharedMemory(name=shmName)
+    greeks = np.array(np.ndarray((len(GREEKS), n), dtype=float, buffer=shm.buf))
+    shm.close()
+    workerModel = portfolio.QuantityMILP(pd.DataFrame(dict(zip(GREEKS, greeks))), maxQuantity, maxLegs)
+    workerSolver = makeSolver(solverSpec, timeLimit=timeLimit, mipGap=mipGap)
+
+
+def solveSetting(setting):
+    (deltaBound, thetaBounds, thetaWeight) = setting
+    model = workerModel
+    model.setBounds(deltaBound, thetaBounds, thetaWeight)
+    solution = model.solve(workerSolver)
+    q = model.quantities
+    held = np.flatnonzero(q)
+    return dict(deltaBound=deltaBound, thetaLo=thetaBounds[0], thetaHi=thetaBounds[1], thetaWeight=thetaWeight,
+                status=solution.status, objective=model.objective if solution.hasSolution else np.nan,
+                solveTime=solution.solveTime, delta=float(q @ model.delta), gamma=float(q @ model.gamma),
+                theta=float(q @ model.theta), positions=held.tolist(), quantities=q[held].tolist())
+
+
+def grid(deltaBounds=(0.05, 0.1, 0.2), thetaBounds=((-10., 0.), (-5., 0.), (-2., 0.)), thetaWeights=(5., 10., 20.)):
+    return list(itertools.product(deltaBounds, thetaBounds, thetaWeights))
+
+
+def paretoMask(points):
+    # points: one row per portfolio, every column to be maximized. A row is on the frontier when no
+    # other row is at least as good in every column and better in one.
+    points = np.asarray(points, dtype=float)
+    geq = (points[None, :, :] >= points[:, None, :]).all(axis=2)
+    gt = (points[None, :, :] > points[:, None, :]).any(axis=2)
+    return ~(geq & gt).any(axis=1)
+
+
+def paretoSweep(rawdata, settings=None, processes=None, solver=None, timeLimit=None, mipGap=None, maxQuantity=15,
+                maxLegs=3):
+    # one row per setting with the portfolio's aggregate greeks, its legs (conIds and quantities) and
+    # whether it is on the gamma / theta / |delta| frontier; empty portfolios never are
+    settings = grid() if settings is None else settings
+    greeks = np.ascontiguousarray(rawdata[GREEKS].values.T, dtype=float)
+    shm = shared_memory.SharedMemory(create=True, size=max(greeks.nbytes, 1))
+    try:
+        np.ndarray(greeks.shape, dtype=float, buffer=shm.buf)[:] = greeks
+        processes = processes or multiprocessing.cpu_count()
+        # neighbouring settings go to the same worker so its warm starts stay close
+        chunksize = max(1, len(settings) // (4 * processes))
+        with multiprocessing.Pool(processes, initWorker, (shm.name, greeks.shape[1], solver, timeLimit, mipGap,
+                                                          maxQuantity, maxLegs)) as pool:
+            results = pool.map(solveSetting, settings, chunksize)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    frontier = pd.DataFrame(results)
+    conIds = rawdata.conId.values
+    frontier['legs'] = [list(zip(conIds[p].tolist(), q)) for (p, q) in zip(frontier.positions, frontier.quantities)]
+    held = frontier.positions.str.len() > 0
+    points = np.column_stack([frontier.gamma, frontier.theta, -frontier.delta.abs()])
+    frontier['pareto'] = False
+    frontier.loc[held, 'pareto'] = paretoMask(points[held.values])
+    return frontier
+
+
+def sweepRows(rawdata, result):
+    # the portfolio of one sweep result as rows for portfolio.comboOrder
+    q = np.zeros(len(rawdata), dtype=int)
+    q[result['positions']] = result['quantities']
+    return portfolio.heldRows(rawdata, q)
+
+
+def parseThetaBounds(text):
+    return tuple(tuple(float(x) for x in pair.split(":")) for pair in text.split(","))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pareto sweep of the portfolio model over its bounds.")
+    parser.add_argument("chain", help="option chain csv as written by the script")
+    parser.add_argument("--today", default="20181028", help="YYYYMMDD the durations count from")
+    parser.add_argument("--delta", default="0.05,0.1,0.2", help="comma separated delta bounds")
+    parser.add_argument("--theta", default="-10:0,-5:0,-2:0", help="comma separated lo:hi theta bounds")
+    parser.add_argument("--weight", default="5,10,20", help="comma separated theta weights")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--solver", help="solvers.makeSolver spec")
+    parser.add_argument("--time-limit", type=float, default=60.)
+    parser.add_argument("--out", help="write the sweep as csv")
+    args = parser.parse_args(argv)
+
+    df = pd.read_csv(args.chain, encoding='gbk', dtype=dict(expirations=str))
+    rawdata = portfolio.pruneChain(portfolio.prepareChain(df, args.today)[portfolio.RAW_COLUMNS])
+    settings = grid([float(x) for x in args.delta.split(",")], parseThetaBounds(args.theta),
+                    [float(x) for x in args.weight.split(",")])
+    frontier = paretoSweep(rawdata, settings, args.processes, args.solver, args.time_limit)
+    columns = ['deltaBound', 'thetaLo', 'thetaHi', 'thetaWeight', 'status', 'objective', 'gamma', 'theta', 'delta',
+               'legs', 'pareto']
+    print(frontier[columns].to_string())
+    if args.out:
+        frontier[columns].to_csv(args.out, index=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
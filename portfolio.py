@@ -0,0 +1,459 @@
+import time
+from threading import Event, Thread
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from pyomo.environ import ConcreteModel, Set, RangeSet, Var, Binary, Integers, Objective, Constraint, maximize, value
+
+from ibapi.contract import Contract, ComboLeg
+from ibapi.order import Order
+
+from solvers import makeSolver
+
+# the portfolio model over an option chain snapshot: every option may be held at each quantity in
+# QUANTITIES, at most 3 legs, delta within +-0.1 and theta within -5..0, maximizing gamma + 10 * theta.
+# pruneChain drops the options no optimum needs before any of the models is built.
+# buildQuantityModel states it with one integer quantity per option; replicateChain and buildModel
+# are the original formulation with one binary per (option, quantity) row. QuantityMILP is
+# buildQuantityModel assembled as sparse matrices and solved by one of the backends in solvers.py.
+
+QUANTITIES = range(-15, 16)
+RAW_COLUMNS = ['conId', 'delta', 'gamma', 'theta', 'right', 'duration', 'strikes', 'price', 'symbol', 'exchange']
+
+
+def prepareChain(df, today):
+    # days to expiry from today (YYYYMMDD) and the model price, dropping options without greeks
+    df = df.assign(duration=(pd.to_datetime(df.expirations, format='%Y%m%d') - pd.to_datetime(today)).dt.days,
+                   price=df.optPrice)
+    return df.dropna(how='any', subset=['gamma', 'theta', 'delta', 'price', 'multiplier'])
+
+
+def pruneChain(rawdata, maxLegs=3, decimals=None, thetaWeight=10.):
+    # options with the same delta and theta are interchangeable in the constraints: any portfolio
+    # holding one of them at some quantity stays feasible holding another instead, and the objective
+    # gamma + thetaWeight * theta decides which is better. So of each such group only the maxLegs best
+    # (for long legs) and the maxLegs worst (for short legs) can be in an optimum, and the optimum of
+    # the pruned chain is the optimum of the chain. Options at different delta or theta are never
+    # interchangeable under two-sided delta and theta bounds, whatever their gamma. decimals treats
+    # delta and theta equal to that many decimals as the same (near duplicates), which is no longer
+    # exact and makes the result depend on thetaWeight. The pruning only holds for the greeks it saw:
+    # a model kept up to date as they move (PortfolioTracker) needs the unpruned chain. Returns the
+    # remaining rows in rawdata's order.
+    delta = rawdata.delta.values.astype(float)
+    theta = rawdata.theta.values.astype(float)
+    if decimals is not None:
+        (delta, theta) = (np.round(delta, decimals), np.round(theta, decimals))
+    (_, group, sizes) = np.unique(np.column_stack([delta, theta]), axis=0, return_inverse=True,
+                                  return_counts=True)
+    group = group.ravel()
+    alpha = rawdata.gamma.values + thetaWeight * rawdata.theta.values
+    order = np.lexsort((alpha, group))
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order)) - starts[group[order]]
+    keep = (rank < maxLegs) | (rank >= sizes[group] - maxLegs)
+    return rawdata[keep]
+
+
+def replicateChain(rawdata, quantities=QUANTITIES):
+    # one row per (option, quantity) with the greeks scaled by the quantity
+    datalist = []
+    for i in quantities:
+        mid_data = rawdata.copy(deep=True)
+        mid_data['delta'] = mid_data['delta'] * i
+        mid_data['gamma'] = mid_data['gamma'] * i
+        mid_data['theta'] = mid_data['theta'] * i
+        mid_data['parameter'] = i
+        datalist.append(mid_data)
+    return pd.concat(datalist, axis=0)
+
+
+def buildModel(inputdata):
+    # one binary per row of replicateChain's output
+    og = inputdata.gamma.values
+    od = inputdata.delta.values
+    ot = inputdata.theta.values
+
+    def searchForAlpha(m):
+        return sum((m.x[i] * og[i - 1] + 10 * m.x[i] * ot[i - 1] for i in
+                    m.I))  # -150*abs(3-sum((m.x[i] for i in m.I)))-10*abs(sum((m.x[i]*od[i-1]for i in m.I)))
+
+    def threelegs_up(m):
+        return sum((m.x[i] for i in m.I)) <= 3
+
+    def threelegs_down(m):
+        return sum((m.x[i] for i in m.I)) >= -3
+
+    def deltaBound_up(m):
+        return sum((m.x[i] * od[i - 1] for i in m.I)) <= 0.1
+
+    def deltaBound_down(m):
+        return sum((m.x[i] * od[i - 1] for i in m.I)) >= -0.1
+
+    def thetaBound_up(m):
+        return sum((m.x[i] * ot[i - 1] for i in m.I)) <= 0
+
+    def thetaBound_down(m):
+        return sum((m.x[i] * ot[i - 1] for i in m.I)) >= -5
+
+    model = ConcreteModel()
+
+    model.I = Set(initialize=RangeSet(inputdata.shape[0]))
+
+    model.x = Var(model.I, domain=Binary)
+
+    model.TotalProfit = Objective(rule=searchForAlpha, sense=maximize)
+
+    model.legbound_up = Constraint(rule=threelegs_up)
+    model.legbound_down = Constraint(rule=threelegs_down)
+
+    model.deltabound_up = Constraint(rule=deltaBound_up)
+    model.deltabound_down = Constraint(rule=deltaBound_down)
+
+    model.thetabound_up = Constraint(rule=thetaBound_up)
+    model.thetabound_down = Constraint(rule=thetaBound_down)
+    return model
+
+
+def buildQuantityModel(rawdata, maxQuantity=15, maxLegs=3):
+    # q[i] is the net signed quantity of option i. The replicated model may pick one option at up to
+    # maxLegs distinct quantities, each pick counting as a leg, so pick[i, k] marks the k-th pick of
+    # option i and lets |q[i]| grow by maxQuantity - k + 1 (15, then 14, then 13): the same optimum
+    # with 1 + maxLegs variables per option instead of len(QUANTITIES), and one combo leg per option.
+    og = rawdata.gamma.values
+    od = rawdata.delta.values
+    ot = rawdata.theta.values
+
+    def searchForAlpha(m):
+        return sum(m.q[i] * (og[i - 1] + 10 * ot[i - 1]) for i in m.I)
+
+    def legs(m):
+        return sum(m.pick[i, k] for i in m.I for k in m.K) <= maxLegs
+
+    def pickOrder(m, i, k):
+        return m.pick[i, k] <= m.pick[i, k - 1] if k > 1 else Constraint.Skip
+
+    def pickedLong(m, i):
+        return m.q[i] <= sum((maxQuantity - k + 1) * m.pick[i, k] for k in m.K)
+
+    def pickedShort(m, i):
+        return m.q[i] >= -sum((maxQuantity - k + 1) * m.pick[i, k] for k in m.K)
+
+    def deltaBound_up(m):
+        return sum(m.q[i] * od[i - 1] for i in m.I) <= 0.1
+
+    def deltaBound_down(m):
+        return sum(m.q[i] * od[i - 1] for i in m.I) >= -0.1
+
+    def thetaBound_up(m):
+        return sum(m.q[i] * ot[i - 1] for i in m.I) <= 0
+
+    def thetaBound_down(m):
+        return sum(m.q[i] * ot[i - 1] for i in m.I) >= -5
+
+    capacity = sum(maxQuantity - k for k in range(maxLegs))
+
+    model = ConcreteModel()
+
+    model.I = RangeSet(rawdata.shape[0])
+    model.K = RangeSet(maxLegs)
+
+    model.q = Var(model.I, domain=Integers, bounds=(-capacity, capacity))
+    model.pick = Var(model.I, model.K, domain=Binary)
+
+    model.TotalProfit = Objective(rule=searchForAlpha, sense=maximize)
+
+    model.legbound = Constraint(rule=legs)
+    model.pickorder = Constraint(model.I, model.K, rule=pickOrder)
+    model.pickedlong = Constraint(model.I, rule=pickedLong)
+    model.pickedshort = Constraint(model.I, rule=pickedShort)
+
+    model.deltabound_up = Constraint(rule=deltaBound_up)
+    model.deltabound_down = Constraint(rule=deltaBound_down)
+
+    model.thetabound_up = Constraint(rule=thetaBound_up)
+    model.thetabound_down = Constraint(rule=thetaBound_down)
+    return model
+
+
+def heldRows(rawdata, quantities):
+    # the held options as rows shaped like replicateChain's: greeks scaled by the quantity, which
+    # goes into 'parameter'
+    quantities = np.rint(np.asarray(quantities, dtype=float)).astype(int)
+    re_df = rawdata[quantities != 0].copy()
+    held = quantities[quantities != 0]
+    re_df['delta'] = re_df['delta'] * held
+    re_df['gamma'] = re_df['gamma'] * held
+    re_df['theta'] = re_df['theta'] * held
+    re_df['parameter'] = held
+    return re_df
+
+
+def selectedQuantities(model, rawdata):
+    return heldRows(rawdata, [value(model.q[i + 1]) for i in range(rawdata.shape[0])])
+
+
+class QuantityMILP:
+    # buildQuantityModel as arrays: x = [q, pick[:, 1], ..., pick[:, maxLegs]] and the rows of A in
+    # the order legbound, pickorder, pickedlong, pickedshort, delta, theta with lo <= A @ x <= hi.
+    # The solvers minimize, so c is the negated objective. buildTime is the assembly time in seconds.
+    # The delta and theta rows store every option, zeros included, so updateGreeks only rewrites
+    # coefficients and never changes the sparsity pattern. deltaBound, thetaBounds and thetaWeight
+    # are the literals of the original model, setBounds changes them in place.
+    def __init__(self, rawdata, maxQuantity=15, maxLegs=3, deltaBound=0.1, thetaBounds=(-5., 0.), thetaWeight=10.):
+        start = time.perf_counter()
+        self.rawdata = rawdata
+        self.maxLegs = maxLegs
+        self.thetaWeight = thetaWeight
+        og = self.gamma = rawdata.gamma.values.astype(float)
+        od = self.delta = rawdata.delta.values.astype(float)
+        ot = self.theta = rawdata.theta.values.astype(float)
+        n = self.n = len(og)
+        caps = maxQuantity - np.arange(maxLegs)
+        eye = sp.identity(n, format="csr")
+        capBlock = sp.hstack([cap * eye for cap in caps])
+        noQ = sp.csr_matrix((n * (maxLegs - 1), n))
+        order = sp.kron(sp.diags([-1., 1.], [0, 1], shape=(maxLegs - 1, maxLegs)), eye)
+        greeks = sp.csr_matrix((np.concatenate([od, ot]), np.tile(np.arange(n), 2), [0, n, 2 * n]),
+                               shape=(2, n * (1 + maxLegs)))
+        self.A = sp.vstack([
+            sp.hstack([sp.csr_matrix((1, n)), np.ones((1, n * maxLegs))]),
+            sp.hstack([noQ, order]),
+            sp.hstack([eye, -capBlock]),
+            sp.hstack([eye, capBlock]),
+            greeks,
+        ], format="csr")
+        (self.deltaRow, self.thetaRow) = (self.A.shape[0] - 2, self.A.shape[0] - 1)
+        self.deltaEntries = slice(self.A.indptr[self.deltaRow], self.A.indptr[self.deltaRow + 1])
+        self.thetaEntries = slice(self.A.indptr[self.thetaRow], self.A.indptr[self.thetaRow + 1])
+        nOrder = n * (maxLegs - 1)
+        self.lo = np.concatenate([[-np.inf], np.full(nOrder, -np.inf), np.full(n, -np.inf), np.zeros(n),
+                                  [-deltaBound, thetaBounds[0]]])
+        self.hi = np.concatenate([[maxLegs], np.zeros(nOrder), np.zeros(n), np.full(n, np.inf),
+                                  [deltaBound, thetaBounds[1]]])
+        capacity = self.capacity = caps.sum()
+        self.c = np.concatenate([-(og + thetaWeight * ot), np.zeros(n * maxLegs)])
+        self.lb = np.concatenate([np.full(n, -capacity), np.zeros(n * maxLegs)])
+        self.ub = np.concatenate([np.full(n, capacity), np.ones(n * maxLegs)])
+        self.integrality = np.ones(len(self.c))
+        self.solution = None
+        self.buildTime = time.perf_counter() - start
+
+    def solve(self, solver=None, warmStart=True):
+        # solver is a solvers.MILPSolver or a makeSolver spec. The solve is seeded with the legs of
+        # the previous solution (warmStart) or with no legs, leaving the quantities to the solver:
+        # any quantities within the picked legs' capacities, zero included, are feasible, so the
+        # seed survives greeks that moved the previous portfolio out of the delta/theta bounds. On
+        # chains where nothing beats the empty portfolio HiGHS can take minutes to find it unseeded.
+        if solver is None or isinstance(solver, str):
+            solver = makeSolver(solver)
+        x0 = np.concatenate([np.full(self.n, np.nan), np.zeros(len(self.c) - self.n)])
+        if warmStart and self.solution is not None and self.solution.hasSolution:
+            x0[self.n:] = np.rint(self.solution.x[self.n:])
+        self.solution = solver.solve(self, x0)
+        return self.solution
+
+    def updateGreeks(self, delta, gamma, theta):
+        # new greeks for every option, in rawdata's order: rewrites the objective and the delta and
+        # theta rows in place, the previous solution stays as the next solve's starting point
+        self.delta = np.asarray(delta, dtype=float)
+        self.gamma = np.asarray(gamma, dtype=float)
+        self.theta = np.asarray(theta, dtype=float)
+        self.c[:self.n] = -(self.gamma + self.thetaWeight * self.theta)
+        self.A.data[self.deltaEntries] = self.delta
+        self.A.data[self.thetaEntries] = self.theta
+
+    def setBounds(self, deltaBound=None, thetaBounds=None, thetaWeight=None):
+        if deltaBound is not None:
+            (self.lo[self.deltaRow], self.hi[self.deltaRow]) = (-deltaBound, deltaBound)
+        if thetaBounds is not None:
+            (self.lo[self.thetaRow], self.hi[self.thetaRow]) = thetaBounds
+        if thetaWeight is not None:
+            self.thetaWeight = thetaWeight
+            self.c[:self.n] = -(self.gamma + thetaWeight * self.theta)
+
+    def isFeasible(self, x, tol=1e-7):
+        Ax = self.A @ x
+        return bool(np.all(Ax >= self.lo - tol) and np.all(Ax <= self.hi + tol))
+
+    @property
+    def objective(self):
+        return -self.solution.objective
+
+    @property
+    def quantities(self):
+        if self.solution is None or not self.solution.hasSolution:
+            return np.zeros(self.n, dtype=int)
+        return np.rint(self.solution.x[:self.n]).astype(int)
+
+    def selected(self):
+        return heldRows(self.rawdata.assign(delta=self.delta, gamma=self.gamma, theta=self.theta), self.quantities)
+
+
+def topPortfolios(model, k=5, solver=None):
+    # the k best portfolios of a QuantityMILP whose sets of options differ, best first. After each
+    # solve a no-good cut, sum of pick[i, 1] over the options i just held <= their number - 1, keeps
+    # every later portfolio from holding all of them again, so a combo that cannot be executed is not
+    # followed by the same legs at other quantities. Stops early when only the empty portfolio is left.
+    # The cuts are removed afterwards and model.solution is the best portfolio. Returns (ranking, rows):
+    # ranking has the objective, solver status, aggregate delta/gamma/theta and legs (conId, quantity)
+    # of each portfolio, rows the held rows of each for comboOrder.
+    if solver is None or isinstance(solver, str):
+        solver = makeSolver(solver)
+    (A, lo, hi) = (model.A, model.lo, model.hi)
+    (found, objectives, statuses, best) = ([], [], [], None)
+    try:
+        for rank in range(k):
+            # the previous legs violate the cut just added, the empty portfolio never does
+            solution = model.solve(solver, warmStart=rank == 0)
+            q = model.quantities
+            held = np.flatnonzero(q)
+            if not solution.hasSolution or len(held) == 0:
+                break
+            best = best or solution
+            found.append(q)
+            objectives.append(model.objective)
+            statuses.append(solution.status)
+            cut = sp.csr_matrix((np.ones(len(held)), held + model.n, [0, len(held)]), shape=(1, A.shape[1]))
+            model.A = sp.vstack([model.A, cut], format="csr")
+            model.lo = np.append(model.lo, -np.inf)
+            model.hi = np.append(model.hi, len(held) - 1)
+    finally:
+        (model.A, model.lo, model.hi) = (A, lo, hi)
+        model.solution = best or model.solution
+
+    Q = np.array(found, dtype=int).reshape(len(found), model.n)
+    greeks = Q @ np.column_stack([model.delta, model.gamma, model.theta])
+    conIds = model.rawdata.conId.values
+    ranking = pd.DataFrame(dict(objective=objectives, status=statuses, delta=greeks[:, 0], gamma=greeks[:, 1],
+                                theta=greeks[:, 2],
+                                legs=[list(zip(conIds[q != 0].tolist(), q[q != 0].tolist())) for q in Q]))
+    current = model.rawdata.assign(delta=model.delta, gamma=model.gamma, theta=model.theta)
+    return (ranking, [heldRows(current, q) for q in Q])
+
+
+class PortfolioTracker:
+    # keeps a QuantityMILP optimal as the chain's greeks move. TestApp.tickOptionComputation writes the
+    # model ticks into the OptionChainStore and calls notify(); the tracker thread then copies the
+    # current greeks of the model's options into it in place and re-solves, warm started from the
+    # held portfolio, when that portfolio left the delta/theta bounds or the objective coefficients
+    # drifted materially since the last solve. No portfolio's objective moves by more than
+    # capacity * max |change of a coefficient|, so that drift is what is compared with
+    # threshold * max(|objective|, 1). A solve cut short by the solver's time limit is picked up again
+    # on the next step, so a tracker with a short limit keeps improving between ticks. onSolution, if
+    # given, receives selected() after every solve. Build the model on the unpruned chain: pruneChain
+    # only holds for the greeks it was given.
+    def __init__(self, model, chain, solver=None, threshold=0.01, onSolution=None):
+        self.model = model
+        self.chain = chain
+        self.solver = solver if solver is not None and not isinstance(solver, str) else makeSolver(solver)
+        self.threshold = threshold
+        self.onSolution = onSolution
+        # rawdata is indexed by reqId, as OptionChainStore.to_pandas leaves it
+        self.rows = np.array([chain.reqId2row[reqId] for reqId in model.rawdata.index])
+        self.solvedCosts = model.c[:model.n].copy() if model.solution is not None else None
+        self.changed = Event()
+        self.stopped = Event()
+        self.thread = None
+        self.nUpdates = 0
+        self.nSolves = 0
+        self.lastSolveTime = np.nan
+
+    def notify(self):
+        # EReader thread
+        self.changed.set()
+
+    def latest(self, name, current):
+        # options without a model tick yet keep their previous greek
+        values = self.chain[name][self.rows]
+        return np.where(np.isfinite(values), values, current)
+
+    def drift(self):
+        if self.solvedCosts is None:
+            return np.inf
+        return self.model.capacity * np.abs(self.model.c[:self.model.n] - self.solvedCosts).max()
+
+    def refresh(self):
+        # folds the chain's greeks into the model, True when a re-solve is due
+        model = self.model
+        model.updateGreeks(self.latest('delta', model.delta), self.latest('gamma', model.gamma),
+                           self.latest('theta', model.theta))
+        self.nUpdates += 1
+        solution = model.solution
+        if solution is None or not solution.hasSolution or not model.isFeasible(solution.x):
+            return True
+        if solution.status == "timeLimit":
+            return True
+        return self.drift() > self.threshold * max(abs(model.objective), 1.)
+
+    def step(self):
+        if not self.refresh():
+            return False
+        solution = self.model.solve(self.solver)
+        self.solvedCosts = self.model.c[:self.model.n].copy()
+        self.nSolves += 1
+        self.lastSolveTime = solution.solveTime
+        if self.onSolution is not None:
+            self.onSolution(self.model.selected())
+        return True
+
+    def run(self, maxWait=1.):
+        while not self.stopped.is_set():
+            self.changed.wait(maxWait)
+            self.changed.clear()
+            self.step()
+
+    def start(self, maxWait=1.):
+        self.thread = Thread(target=self.run, args=(maxWait,), name="portfolio", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()
+        self.changed.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def selectedRows(model, inputdata):
+    # the rows of inputdata the solved model holds
+    x_values = []
+    for i in range(0, inputdata.shape[0]):
+        x_values.append(value(model.x[i + 1]))
+    inputdata['selected'] = x_values
+    return inputdata[inputdata.selected > 0.9]
+
+
+def comboOrder(re_df, totalQuantity=10):
+    # BAG contract with one leg per selected row and a limit order at the legs' net price
+    contract = Contract()
+    contract.symbol = re_df.symbol.unique()[0]
+    contract.secType = "BAG"
+    contract.currency = "USD"
+    contract.exchange = re_df.exchange.unique()[0]
+    contract.comboLegs = []
+
+    comboprice = 0
+
+    for arow in enumerate(re_df.iterrows()):
+        acontract = arow[1][1]
+
+        newComboLeg = ComboLeg()
+        newComboLeg.conId = acontract.conId
+        newComboLeg.ratio = abs(acontract.parameter)
+        newComboLeg.exchange = acontract.exchange
+        if acontract.parameter > 0:
+            newComboLeg.action = 'BUY'
+        else:
+            newComboLeg.action = 'SELL'
+
+        contract.comboLegs.append(newComboLeg)
+        comboprice += acontract.parameter * acontract.price
+
+    order = Order()
+    order.action = 'BUY'
+    order.orderType = "LMT"
+    order.totalQuantity = totalQuantity
+    order.lmtPrice = float(format(comboprice, '0.1f'))
+    return (contract, order)
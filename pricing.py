@@ -0,0 +1,298 @@
+import collections
+import datetime
+import logging
+import time
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import least_squares
+from scipy.special import ndtr
+
+# Greeks follow the TWS model tick conventions: vega per 1% of volatility, theta per calendar day.
+
+SQRT2PI = np.sqrt(2 * np.pi)
+
+
+def yearsToExpiry(expirations, now=None, expiryHour=16):
+    # YYYYMMDD expirations to year fractions, expiring at expiryHour local time
+    now = now or datetime.datetime.now()
+    expirations = np.asarray(expirations, dtype=str)
+    exps = pd.to_datetime(expirations.ravel(), format="%Y%m%d") + pd.Timedelta(hours=expiryHour)
+    years = (exps - pd.Timestamp(now)).total_seconds().values / (365. * 24 * 3600)
+    return np.maximum(years, 1. / (365 * 24)).reshape(expirations.shape)
+
+
+def black76(F, K, T, sigma, r=0., isCall=True):
+    # price and greeks of options on a forward/future F; all arguments broadcast, isCall is a bool array
+    F, K, T, sigma, r, isCall = np.broadcast_arrays(np.asarray(F, float), np.asarray(K, float), np.asarray(T, float),
+                                                    np.asarray(sigma, float), np.asarray(r, float), np.asarray(isCall))
+    sqrtT = np.sqrt(T)
+    volT = sigma * sqrtT
+    d1 = (np.log(F / K) + 0.5 * volT * volT) / volT
+    d2 = d1 - volT
+    df = np.exp(-r * T)
+    pdf = np.exp(-0.5 * d1 * d1) / SQRT2PI
+    sign = np.where(isCall, 1., -1.)
+    Nd1 = ndtr(sign * d1)
+    Nd2 = ndtr(sign * d2)
+
+    price = sign * df * (F * Nd1 - K * Nd2)
+    delta = sign * df * Nd1
+    gamma = df * pdf / (F * volT)
+    vega = F * df * pdf * sqrtT
+    theta = -F * df * pdf * sigma / (2 * sqrtT) + r * price
+    return dict(price=price, delta=delta, gamma=gamma, vega=vega / 100, theta=theta / 365)
+
+
+def blackScholes(S, K, T, sigma, r=0., q=0., isCall=True):
+    # options on a spot S with continuous dividend yield q, greeks with respect to the spot
+    S, K, T, sigma, r, q, isCall = np.broadcast_arrays(np.asarray(S, float), np.asarray(K, float),
+                                                       np.asarray(T, float), np.asarray(sigma, float),
+                                                       np.asarray(r, float), np.asarray(q, float),
+                                                       np.asarray(isCall))
+    sqrtT = np.sqrt(T)
+    volT = sigma * sqrtT
+    d1 = (np.log(S / K) + (r - q + 0.5 * sigma * sigma) * T) / volT
+    d2 = d1 - volT
+    dq = np.exp(-q * T)
+    dr = np.exp(-r * T)
+    pdf = np.exp(-0.5 * d1 * d1) / SQRT2PI
+    sign = np.where(isCall, 1., -1.)
+    Nd1 = ndtr(sign * d1)
+    Nd2 = ndtr(sign * d2)
+
+    price = sign * (S * dq * Nd1 - K * dr * Nd2)
+    delta = sign * dq * Nd1
+    gamma = dq * pdf / (S * volT)
+    vega = S * dq * pdf * sqrtT
+    theta = -S * dq * pdf * sigma / (2 * sqrtT) - sign * (r * K * dr * Nd2 - q * S * dq * Nd1)
+    return dict(price=price, delta=delta, gamma=gamma, vega=vega / 100, theta=theta / 365)
+
+
+def interpolateVols(strikes, expirations, vols):
+    # fills missing vols by linear interpolation over strike within each expiry (flat beyond the
+    # quoted strikes); expiries with no vol at all stay NaN
+    vols = np.array(vols, dtype=float)
+    for aexp in np.unique(expirations):
+        rows = np.flatnonzero(expirations == aexp)
+        known = rows[np.isfinite(vols[rows]) & (vols[rows] > 0)]
+        if len(known) == 0:
+            continue
+        order = np.argsort(strikes[known])
+        vols[rows] = np.interp(strikes[rows], strikes[known][order], vols[known][order])
+    return vols
+
+
+def fillModelGreeks(chain, undPrice=None, r=0., replace=False, now=None):
+    # computes Black-76 greeks for the rows of an OptionChainStore the TWS model tick did not fill
+    # (or for every row with replace=True), using each row's implied vol or one interpolated from its
+    # expiry. The forward is the row's undPrice, else undPrice. Returns the number of rows filled.
+    if len(chain) == 0:
+        return 0
+    F = np.array(chain['undPrice'], dtype=float)
+    if undPrice is not None:
+        F[~np.isfinite(F)] = undPrice
+    vols = interpolateVols(chain['strikes'], chain['expirations'], chain['impliedVol'])
+    rows = np.isfinite(F) & np.isfinite(vols)
+    if not replace:
+        rows &= ~np.isfinite(chain['gamma'])
+    rows = np.flatnonzero(rows)
+    if len(rows) == 0:
+        return 0
+
+    greeks = black76(F[rows], chain['strikes'][rows], yearsToExpiry(chain['expirations'][rows], now),
+                     vols[rows], r, chain['right'][rows] == 'C')
+    for name in ('gamma', 'theta', 'delta', 'vega'):
+        chain[name][rows] = greeks[name]
+    chain['undPrice'][rows] = F[rows]
+    chain['impliedVol'][rows] = vols[rows]
+    missingPrice = rows[~np.isfinite(chain['optPrice'][rows])]
+    chain['optPrice'][missingPrice] = greeks['price'][np.isin(rows, missingPrice)]
+    return len(rows)
+
+
+def impliedVol(price, F, K, T, r=0., isCall=True, tol=1e-8, maxIter=100, volLo=1e-4, volHi=5.):
+    # inverts Black-76 for whole arrays at once: Newton steps on vega, falling back to bisection
+    # of the [volLo, volHi] bracket whenever a step leaves it. Prices outside the no-arbitrage
+    # bounds, or not converged after maxIter, give NaN. Returns (vols, stats).
+    started = time.perf_counter()
+    price, F, K, T, r, isCall = np.broadcast_arrays(np.asarray(price, float), np.asarray(F, float),
+                                                    np.asarray(K, float), np.asarray(T, float),
+                                                    np.asarray(r, float), np.asarray(isCall))
+    df = np.exp(-r * T)
+    intrinsic = df * np.maximum(np.where(isCall, F - K, K - F), 0)
+    upper = df * np.where(isCall, F, K)
+    valid = np.isfinite(price) & (price > intrinsic) & (price < upper)
+
+    # Brenner-Subrahmanyam start, exact at the money
+    sigma = np.clip(np.sqrt(2 * np.pi / T) * price / (df * F), volLo, volHi)
+    sigma[~valid] = np.nan
+    lo = np.full(price.shape, volLo)
+    hi = np.full(price.shape, volHi)
+    active = np.flatnonzero(valid)
+    maxError = 0.
+    iterations = 0
+    while len(active) and iterations < maxIter:
+        iterations += 1
+        g = black76(F[active], K[active], T[active], sigma[active], r[active], isCall[active])
+        diff = g['price'] - price[active]
+        done = np.abs(diff) <= tol * (1 + price[active])
+        if done.any():
+            maxError = max(maxError, np.abs(diff[done]).max())
+
+        above = diff > 0
+        hi[active[above]] = sigma[active[above]]
+        lo[active[~above]] = sigma[active[~above]]
+        with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+            step = sigma[active] - diff / (100 * g['vega'])
+        bisect = ~np.isfinite(step) | (step <= lo[active]) | (step >= hi[active])
+        step[bisect] = 0.5 * (lo[active] + hi[active])[bisect]
+
+        sigma[active[~done]] = step[~done]
+        active = active[~done]
+
+    sigma[active] = np.nan
+    stats = dict(n=int(valid.sum()), converged=int(valid.sum()) - len(active), iterations=iterations,
+                 maxPriceError=float(maxError), seconds=time.perf_counter() - started)
+    return sigma, stats
+
+
+def chainImpliedVols(chain, undPrice=None, r=0., now=None):
+    # implied vols of every row of an OptionChainStore from its bid, ask, bid/ask mid and last
+    # prices, as {name: (vols, stats)}
+    F = np.array(chain['undPrice'], dtype=float)
+    if undPrice is not None:
+        F[~np.isfinite(F)] = undPrice
+    T = yearsToExpiry(chain['expirations'], now)
+    isCall = chain['right'] == 'C'
+    bid = chain['bid']
+    ask = chain['ask']
+    mid = np.where((bid > 0) & (ask >= bid), 0.5 * (bid + ask), np.nan)
+
+    vols = {}
+    for (name, prices) in (('bid', bid), ('ask', ask), ('mid', mid), ('last', chain['optPrice'])):
+        vols[name] = impliedVol(prices, F, chain['strikes'], T, r, isCall)
+        stats = vols[name][1]
+        logging.info('implied vols from %s: %d/%d converged in %d iterations, max price error %.2e, %.6fs', name,
+                     stats['converged'], stats['n'], stats['iterations'], stats['maxPriceError'], stats['seconds'])
+    return vols
+
+
+class VolSurface:
+    # raw SVI smile per expiry, total variance w(k) = a + b * (rho * (k - m) + sqrt((k - m)^2 + s^2))
+    # in log-moneyness k = log(K / F), fitted to whatever implied vols the chain has. update() only
+    # records a quote and marks its expiry dirty (cheap enough for the EReader thread); the next query
+    # refits the dirty expiries starting from their previous parameters. Expiries with fewer than
+    # minQuotes quotes take total variance interpolated in time from their neighbours, and total
+    # variance is made non-decreasing in time at every k to keep the surface free of calendar arbitrage.
+    PARAM_LO = np.array([-1., 0., -0.999, -2., 1e-4])
+    PARAM_HI = np.array([4., 5., 0.999, 2., 5.])
+
+    def __init__(self, minQuotes=5, now=None, maxNfev=200, refitNfev=20):
+        self.minQuotes = minQuotes
+        self.now = now
+        self.maxNfev = maxNfev
+        self.refitNfev = refitNfev
+        self.lock = Lock()
+        self.quotes = collections.defaultdict(dict)  # expiry -> {strike: vol}
+        self.forwards = {}
+        self.params = {}
+        self.dirty = set()
+
+    def update(self, expiry, strike, vol, forward=None):
+        # no vol computed: ibapi hands on TWS's -1 as None, older versions as -1 or DBL_MAX
+        if vol is None or not np.isfinite(vol) or not 0 < vol < 5:
+            return
+        with self.lock:
+            self.quotes[expiry][strike] = vol
+            if forward is not None and 0 < forward < 1e300:
+                self.forwards[expiry] = forward
+            self.dirty.add(expiry)
+
+    def updateChain(self, chain, undPrice=None):
+        for (expiry, strike, vol, forward) in zip(chain['expirations'], chain['strikes'], chain['impliedVol'],
+                                                  chain['undPrice']):
+            if np.isfinite(vol):
+                self.update(expiry, strike, vol, forward if np.isfinite(forward) else undPrice)
+
+    @staticmethod
+    def svi(params, k):
+        (a, b, rho, m, s) = params
+        return a + b * (rho * (k - m) + np.sqrt((k - m) ** 2 + s * s))
+
+    def refit(self):
+        with self.lock:
+            dirty = [(expiry, dict(self.quotes[expiry]), self.forwards.get(expiry)) for expiry in self.dirty]
+            self.dirty.clear()
+        for (expiry, quotes, forward) in dirty:
+            if len(quotes) < self.minQuotes or forward is None:
+                continue
+            T = yearsToExpiry([expiry], self.now)[0]
+            k = np.log(np.fromiter(quotes.keys(), float) / forward)
+            vols = np.fromiter(quotes.values(), float)
+            prev = self.params.get(expiry)
+            if prev is None:
+                # flat smile at the lowest vol: a + b * s = vols.min() ** 2 * T at k = m
+                w0 = vols.min() ** 2 * T
+                x0 = np.array([0.5 * w0, 5. * w0, -0.3, 0., 0.1])
+            else:
+                x0 = prev
+
+            def residuals(x):
+                return np.sqrt(np.maximum(self.svi(x, k), 1e-12) / T) - vols
+
+            fit = least_squares(residuals, np.clip(x0, self.PARAM_LO, self.PARAM_HI),
+                                bounds=(self.PARAM_LO, self.PARAM_HI),
+                                max_nfev=self.maxNfev if prev is None else self.refitNfev)
+            self.params[expiry] = fit.x
+
+    def forward(self, expiry):
+        # the expiry's own forward, else that of the fitted expiry nearest in time
+        if expiry in self.forwards:
+            return self.forwards[expiry]
+        fitted = sorted(self.params)
+        if not fitted:
+            return np.nan
+        fittedT = yearsToExpiry(fitted, self.now)
+        return self.forwards[fitted[np.argmin(np.abs(fittedT - yearsToExpiry([expiry], self.now)[0]))]]
+
+    def totalVariance(self, expiries, strikes):
+        if self.dirty:
+            self.refit()
+        strikes = np.asarray(strikes, dtype=float)
+        expiries = np.broadcast_to(np.asarray(expiries, dtype=str), strikes.shape)
+        fitted = sorted(self.params)
+        if not fitted:
+            return np.full(strikes.shape, np.nan)
+        fittedT = yearsToExpiry(fitted, self.now)
+        T = yearsToExpiry(expiries, self.now)
+        w = np.empty(strikes.shape)
+        for aexp in np.unique(expiries):
+            rows = expiries == aexp
+            k = np.log(strikes[rows] / self.forward(aexp))
+            # every fitted smile at this k, made non-decreasing in T, then interpolated to this expiry
+            smiles = np.maximum.accumulate(np.array([self.svi(self.params[e], k) for e in fitted]), axis=0)
+            Tx = T[rows][0]
+            if Tx <= fittedT[0]:
+                w[rows] = smiles[0] * Tx / fittedT[0]
+            elif Tx >= fittedT[-1]:
+                w[rows] = smiles[-1] * Tx / fittedT[-1]
+            else:
+                j = np.searchsorted(fittedT, Tx)
+                frac = (Tx - fittedT[j - 1]) / (fittedT[j] - fittedT[j - 1])
+                w[rows] = (1 - frac) * smiles[j - 1] + frac * smiles[j]
+        return w
+
+    def vol(self, expiries, strikes):
+        w = self.totalVariance(expiries, strikes)
+        return np.sqrt(np.maximum(w, 0) / yearsToExpiry(np.broadcast_to(expiries, w.shape), self.now))
+
+    def greeks(self, expiries, strikes, isCall, r=0.):
+        # Black-76 price and greeks off the surface for any listed strike, subscribed or not
+        expiries = np.broadcast_to(np.asarray(expiries, dtype=str), np.shape(strikes))
+        vols = self.vol(expiries, strikes)
+        forwards = np.empty(expiries.shape)
+        for aexp in np.unique(expiries):
+            forwards[expiries == aexp] = self.forward(aexp)
+        return black76(forwards, strikes, yearsToExpiry(expiries, self.now), vols, r, isCall)
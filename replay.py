@@ -0,0 +1,190 @@
+import collections
+import inspect
+import pickle
+import queue
+import struct
+import time
+from threading import Thread, Lock
+
+from ibapi import wrapper
+from ibapi.client import EClient
+
+
+# record header: timestamp, method id, payload length. Method names are not repeated per record:
+# the first call of a method appends a NAME record (id NAME_ID, payload the utf-8 name) and later
+# records refer to it by its position among the NAME records of its session. The file is
+# append-only; every recorder opening it starts a session with a SESSION record (id SESSION_ID, no
+# payload), after which method ids count from 0 again.
+HEADER = struct.Struct("<dHI")
+NAME_ID = 0xFFFF
+SESSION_ID = 0xFFFE
+MAGIC = b"IBCB1\n"
+
+
+def reqIdIndex(meth, names=('reqId', 'tickerId')):
+    # position of the request id among the bound method's arguments, -1 if it has none
+    params = list(inspect.signature(meth).parameters)[1:]
+    for (idx, paramName) in enumerate(params):
+        if paramName in names:
+            return idx
+    return -1
+
+
+class CallbackRecorder:
+    # captures every EWrapper callback of one wrapper instance with its arguments and arrival time.
+    # attach() before connecting; the callbacks are pickled on the EReader thread and written
+    # through a buffered file, flush() or close() to make them durable.
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.file.write(HEADER.pack(time.time(), SESSION_ID, 0))
+        self.name2id = {}
+        self.nRecords = 0
+
+    def attach(self, wrap):
+        methods = inspect.getmembers(wrapper.EWrapper, inspect.isfunction)
+        for (methName, meth) in methods:
+            # logAnswer is EWrapper's own logging helper, called from inside the callbacks
+            if methName.startswith("__") or methName == "logAnswer":
+                continue
+            setattr(wrap, methName, self.recordCall(methName, getattr(wrap, methName)))
+
+    def recordCall(self, methName, fn):
+        def recordCall_(*args, **kwargs):
+            self.record(methName, args)
+            return fn(*args, **kwargs)
+
+        return recordCall_
+
+    def record(self, methName, args, stamp=None):
+        payload = pickle.dumps(args, pickle.HIGHEST_PROTOCOL)
+        stamp = stamp if stamp is not None else time.time()
+        with self.lock:
+            methId = self.name2id.get(methName)
+            if methId is None:
+                methId = self.name2id[methName] = len(self.name2id)
+                name = methName.encode("utf-8")
+                self.file.write(HEADER.pack(stamp, NAME_ID, len(name)))
+                self.file.write(name)
+            self.file.write(HEADER.pack(stamp, methId, len(payload)))
+            self.file.write(payload)
+            self.nRecords += 1
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def readCallbacks(path):
+    # yields (timestamp, method name, args) in recorded order, over all sessions of the file; a
+    # truncated last record, as left by a session that died mid-write, is ignored
+    names = []
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a callback log" % path)
+        while True:
+            head = f.read(HEADER.size)
+            if len(head) < HEADER.size:
+                return
+            (stamp, methId, size) = HEADER.unpack(head)
+            payload = f.read(size)
+            if len(payload) < size:
+                return
+            if methId == SESSION_ID:
+                names = []
+            elif methId == NAME_ID:
+                names.append(payload.decode("utf-8"))
+            else:
+                yield (stamp, names[methId], pickle.loads(payload))
+
+
+class ReplayDriver:
+    # feeds a recorded callback stream into a wrapper, typically a TestApp built with connect=False.
+    # With gate=True the client's request methods are replaced on the instance so nothing is sent;
+    # callbacks carrying a request id are held back until the app sends a request with that id, so
+    # code like gammascarping sees its answers in the same order relative to its own requests as in
+    # the recorded session. Callbacks without a request id (nextValidId, orders, errors for -1)
+    # are delivered as they come. speed=None replays as fast as possible, speed=1. at the
+    # recorded pace, speed=10. ten times faster. Once the log is exhausted, held callbacks still
+    # wait for their requests until none has come for holdTimeout seconds.
+    def __init__(self, path, speed=None, gate=True, holdTimeout=10.):
+        self.records = list(readCallbacks(path))
+        self.speed = speed
+        self.gate = gate
+        self.holdTimeout = holdTimeout
+        self.released = set()
+        self.reqId2held = collections.defaultdict(collections.deque)
+        self.releaseQueue = queue.Queue()
+        self.nDelivered = 0
+        self.thread = None
+
+    def attach(self, client):
+        if not self.gate:
+            return
+        methods = inspect.getmembers(EClient, inspect.isfunction)
+        for (methName, meth) in methods:
+            if reqIdIndex(meth) == 0:
+                setattr(client, methName, self.releaseCall)
+
+    def releaseCall(self, reqId, *args, **kwargs):
+        self.releaseQueue.put(reqId)
+
+    def start(self, wrap):
+        # replays on a thread of its own, like the EReader thread of a live session
+        self.attach(wrap)
+        self.thread = Thread(target=self.run, args=(wrap,), name="replay", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def run(self, wrap):
+        name2idx = {}
+        start = time.time()
+        for (stamp, methName, args) in self.records:
+            if self.speed:
+                wait = start + (stamp - self.records[0][0]) / self.speed - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            self.drainReleases(wrap)
+            if methName not in name2idx:
+                name2idx[methName] = reqIdIndex(getattr(wrapper.EWrapper, methName))
+            idx = name2idx[methName]
+            reqId = args[idx] if 0 <= idx < len(args) else -1
+            if self.gate and reqId >= 0 and reqId not in self.released:
+                self.reqId2held[reqId].append((methName, args))
+            else:
+                self.deliver(wrap, methName, args)
+        # whatever is still held is delivered as soon as its request goes out
+        while self.reqId2held:
+            try:
+                reqId = self.releaseQueue.get(timeout=self.holdTimeout)
+            except queue.Empty:
+                return
+            self.release(wrap, reqId)
+
+    def drainReleases(self, wrap):
+        while True:
+            try:
+                reqId = self.releaseQueue.get_nowait()
+            except queue.Empty:
+                return
+            self.release(wrap, reqId)
+
+    def release(self, wrap, reqId):
+        self.released.add(reqId)
+        for (methName, args) in self.reqId2held.pop(reqId, ()):
+            self.deliver(wrap, methName, args)
+
+    def deliver(self, wrap, methName, args):
+        getattr(wrap, methName)(*args)
+        self.nDelivered += 1
+
+    def pending(self):
+        # request ids whose recorded answers were never asked for
+        return sorted(self.reqId2held)
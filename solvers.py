@@ -0,0 +1,274 @@
+import time
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.optimize import milp, Bounds, LinearConstraint
+
+# MILP backends for problems in matrix form: minimize c @ x subject to lo <= A @ x <= hi, lb <= x <= ub,
+# x[j] integer where integrality[j] is 1 (QuantityMILP in portfolio.py is one). Every backend takes
+# timeLimit (wall clock seconds per solve) and mipGap (relative gap to stop at), None leaving the
+# backend's default, and returns a MILPSolution. x0 seeds the solve with a previous solution where
+# the backend can use one (warmStarts), the others ignore it; nan entries of x0 are left for the
+# solver to complete. A problem may be changed in place
+# between solves (coefficients, bounds); the highs backend then applies only the changes to the model
+# it already holds.
+#
+#   makeSolver("highs", timeLimit=5)           in-process HiGHS through highspy
+#   makeSolver("scipy")                        HiGHS bundled with scipy, scipy.optimize.milp
+#   makeSolver("pyomo:cbc", executable=...)    any pyomo solver, e.g. cbc, glpk, cplex, gurobi
+
+
+def snapshot(problem):
+    A = sp.csr_matrix(problem.A)
+    return dict(c=np.array(problem.c, dtype=float), lb=np.array(problem.lb, dtype=float),
+                ub=np.array(problem.ub, dtype=float), lo=np.array(problem.lo, dtype=float),
+                hi=np.array(problem.hi, dtype=float), integrality=np.array(problem.integrality),
+                indptr=A.indptr.copy(), indices=A.indices.copy(), data=A.data.copy())
+
+
+def sameStructure(a, b):
+    # same shape and sparsity pattern, values aside
+    return (len(a['c']) == len(b['c']) and len(a['indptr']) == len(b['indptr']) and len(a['data']) == len(b['data'])
+            and np.array_equal(a['indptr'], b['indptr']) and np.array_equal(a['indices'], b['indices'])
+            and np.array_equal(a['integrality'], b['integrality']))
+
+
+def sameValues(a, b):
+    return all(np.array_equal(a[key], b[key]) for key in ('c', 'lb', 'ub', 'lo', 'hi', 'data'))
+
+
+class MILPSolution:
+    # status is one of optimal, timeLimit (x is the incumbent, if any), infeasible, unbounded, error
+    def __init__(self, status, x=None, objective=np.nan, gap=np.nan, message="", solveTime=np.nan):
+        self.status = status
+        self.x = x
+        self.objective = objective
+        self.gap = gap
+        self.message = message
+        self.solveTime = solveTime
+
+    @property
+    def hasSolution(self):
+        return self.x is not None
+
+    def __repr__(self):
+        return "MILPSolution(%s, objective=%g, gap=%g, %.3fs)" % (self.status, self.objective, self.gap,
+                                                                   self.solveTime)
+
+
+class MILPSolver:
+    name = None
+    warmStarts = False
+
+    def __init__(self, timeLimit=None, mipGap=None, verbose=False):
+        self.timeLimit = timeLimit
+        self.mipGap = mipGap
+        self.verbose = verbose
+
+    def solve(self, problem, x0=None):
+        start = time.perf_counter()
+        solution = self.solveProblem(problem, x0)
+        solution.solveTime = time.perf_counter() - start
+        return solution
+
+    def solveProblem(self, problem, x0):
+        raise NotImplementedError
+
+
+class ScipySolver(MILPSolver):
+    name = "scipy"
+    STATUS = {0: "optimal", 1: "timeLimit", 2: "infeasible", 3: "unbounded"}
+
+    def solveProblem(self, problem, x0):
+        options = dict(disp=self.verbose)
+        if self.timeLimit is not None:
+            options["time_limit"] = self.timeLimit
+        if self.mipGap is not None:
+            options["mip_rel_gap"] = self.mipGap
+        result = milp(problem.c, integrality=problem.integrality, bounds=Bounds(problem.lb, problem.ub),
+                      constraints=LinearConstraint(problem.A, problem.lo, problem.hi), options=options)
+        gap = getattr(result, "mip_gap", None)
+        return MILPSolution(self.STATUS.get(result.status, "error"), result.x,
+                            result.fun if result.x is not None else np.nan,
+                            gap if gap is not None else np.nan, result.message)
+
+
+class HighsSolver(MILPSolver):
+    # keeps one Highs instance per solver; passing the same problem again re-solves the model already
+    # loaded, after changing the costs, bounds and coefficients that differ from the last solve
+    name = "highs"
+    warmStarts = True
+
+    def __init__(self, timeLimit=None, mipGap=None, verbose=False):
+        import highspy
+        MILPSolver.__init__(self, timeLimit, mipGap, verbose)
+        self.highspy = highspy
+        self.highs = highspy.Highs()
+        self.highs.setOptionValue("output_flag", verbose)
+        if timeLimit is not None:
+            self.highs.setOptionValue("time_limit", float(timeLimit))
+        if mipGap is not None:
+            self.highs.setOptionValue("mip_rel_gap", float(mipGap))
+        self.problem = None
+
+    def load(self, problem):
+        highspy = self.highspy
+        A = sp.csc_matrix(problem.A)
+        lp = highspy.HighsLp()
+        lp.num_col_ = A.shape[1]
+        lp.num_row_ = A.shape[0]
+        lp.col_cost_ = np.asarray(problem.c, dtype=float)
+        lp.col_lower_ = np.asarray(problem.lb, dtype=float)
+        lp.col_upper_ = np.asarray(problem.ub, dtype=float)
+        lp.row_lower_ = np.where(np.isinf(problem.lo), -highspy.kHighsInf, problem.lo)
+        lp.row_upper_ = np.where(np.isinf(problem.hi), highspy.kHighsInf, problem.hi)
+        lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+        lp.a_matrix_.start_ = A.indptr
+        lp.a_matrix_.index_ = A.indices
+        lp.a_matrix_.value_ = A.data
+        lp.integrality_ = [highspy.HighsVarType.kInteger if i else highspy.HighsVarType.kContinuous
+                           for i in problem.integrality]
+        self.highs.clearModel()
+        self.highs.passModel(lp)
+        self.problem = problem
+        self.loaded = snapshot(problem)
+        self.loadedRows = np.repeat(np.arange(A.shape[0]), np.diff(self.loaded['indptr']))
+
+    def update(self, problem):
+        # in place changes since the last solve; False when the structure changed and a reload is due
+        (old, new) = (self.loaded, snapshot(problem))
+        if not sameStructure(old, new):
+            return False
+        inf = self.highspy.kHighsInf
+        cols = np.flatnonzero(new['c'] != old['c'])
+        if len(cols):
+            self.highs.changeColsCost(len(cols), cols, new['c'][cols])
+        cols = np.flatnonzero((new['lb'] != old['lb']) | (new['ub'] != old['ub']))
+        if len(cols):
+            self.highs.changeColsBounds(len(cols), cols, new['lb'][cols], new['ub'][cols])
+        rows = np.flatnonzero((new['lo'] != old['lo']) | (new['hi'] != old['hi']))
+        if len(rows):
+            self.highs.changeRowsBounds(len(rows), rows, np.where(np.isinf(new['lo'][rows]), -inf, new['lo'][rows]),
+                                        np.where(np.isinf(new['hi'][rows]), inf, new['hi'][rows]))
+        for k in np.flatnonzero(new['data'] != old['data']):
+            self.highs.changeCoeff(int(self.loadedRows[k]), int(new['indices'][k]), float(new['data'][k]))
+        self.loaded = new
+        return True
+
+    def solveProblem(self, problem, x0):
+        highspy = self.highspy
+        if problem is not self.problem or not self.update(problem):
+            self.load(problem)
+        else:
+            self.highs.clearSolver()
+        if x0 is not None:
+            x0 = np.asarray(x0, dtype=float)
+            given = np.flatnonzero(np.isfinite(x0)).astype(np.int32)
+            self.highs.setSolution(len(given), given, x0[given])
+        self.highs.run()
+        status = self.highs.getModelStatus()
+        info = self.highs.getInfo()
+        hasSolution = info.primal_solution_status == 2  # kSolutionStatusFeasible
+        x = np.array(self.highs.getSolution().col_value) if hasSolution else None
+        S = highspy.HighsModelStatus
+        name = {S.kOptimal: "optimal", S.kTimeLimit: "timeLimit", S.kInfeasible: "infeasible",
+                S.kUnbounded: "unbounded", S.kUnboundedOrInfeasible: "infeasible"}.get(status, "error")
+        return MILPSolution(name, x, info.objective_function_value if hasSolution else np.nan, info.mip_gap,
+                            self.highs.modelStatusToString(status))
+
+
+class PyomoSolver(MILPSolver):
+    # the problem goes through pyomo as one linear expression per row of A, so any solver pyomo
+    # drives can run it; warm starts where the pyomo interface supports them (cbc, cplex, gurobi)
+    OPTIONS = {"glpk": ("tmlim", "mipgap"), "cbc": ("sec", "ratio"), "cplex": ("timelimit", "mip_tolerances_mipgap"),
+               "gurobi": ("TimeLimit", "MIPGap"), "highs": ("time_limit", "mip_rel_gap"),
+               "appsi_highs": ("time_limit", "mip_rel_gap")}
+
+    def __init__(self, solverName, timeLimit=None, mipGap=None, verbose=False, **solverArgs):
+        import pyomo.environ  # registers the solver plugins
+        from pyomo.opt import SolverFactory
+        MILPSolver.__init__(self, timeLimit, mipGap, verbose)
+        self.name = "pyomo:" + solverName
+        self.solver = SolverFactory(solverName, **solverArgs)
+        # pyomo only notices a missing solver executable when it first runs it, with an unrelated error
+        if not self.solver.available(exception_flag=False):
+            raise RuntimeError("pyomo solver %s is not available: is its executable installed and on the PATH, or "
+                               "passed as executable=...?" % solverName)
+        self.warmStarts = getattr(self.solver, "warm_start_capable", lambda: False)()
+        (timeOption, gapOption) = self.OPTIONS.get(solverName, (None, None))
+        if timeLimit is not None and timeOption:
+            self.solver.options[timeOption] = int(np.ceil(timeLimit)) if solverName == "glpk" else timeLimit
+        if mipGap is not None and gapOption:
+            self.solver.options[gapOption] = mipGap
+        self.problem = None
+        self.loaded = None
+        self.model = None
+
+    @staticmethod
+    def matrixModel(problem):
+        from pyomo.environ import (ConcreteModel, RangeSet, Var, Integers, Reals, Objective, Constraint, minimize)
+        from pyomo.core.expr import LinearExpression
+        A = sp.csr_matrix(problem.A)
+        (nRows, nCols) = A.shape
+        model = ConcreteModel()
+        model.J = RangeSet(0, nCols - 1)
+        model.R = RangeSet(0, nRows - 1)
+        model.x = Var(model.J, domain=lambda m, j: Integers if problem.integrality[j] else Reals,
+                      bounds=lambda m, j: (problem.lb[j], problem.ub[j]))
+        xs = [model.x[j] for j in range(nCols)]
+
+        def objective(m):
+            return LinearExpression(constant=0., linear_coefs=list(problem.c), linear_vars=xs)
+
+        def row(m, r):
+            (a, b) = (A.indptr[r], A.indptr[r + 1])
+            expr = LinearExpression(constant=0., linear_coefs=A.data[a:b].tolist(),
+                                    linear_vars=[xs[j] for j in A.indices[a:b]])
+            lo = problem.lo[r] if np.isfinite(problem.lo[r]) else None
+            hi = problem.hi[r] if np.isfinite(problem.hi[r]) else None
+            return (lo, expr, hi)
+
+        model.obj = Objective(rule=objective, sense=minimize)
+        model.rows = Constraint(model.R, rule=row)
+        return model
+
+    def solveProblem(self, problem, x0):
+        from pyomo.environ import value
+        from pyomo.opt import TerminationCondition
+        current = snapshot(problem)
+        if problem is not self.problem or not (sameStructure(current, self.loaded) and sameValues(current, self.loaded)):
+            self.model = self.matrixModel(problem)
+            self.problem = problem
+            self.loaded = current
+        model = self.model
+        kwargs = dict(tee=self.verbose, load_solutions=False)
+        if x0 is not None and self.warmStarts:
+            for (j, v) in enumerate(x0):
+                model.x[j].set_value(v if np.isfinite(v) else None, skip_validation=True)
+            kwargs["warmstart"] = True
+        results = self.solver.solve(model, **kwargs)
+        condition = results.solver.termination_condition
+        status = {TerminationCondition.optimal: "optimal", TerminationCondition.maxTimeLimit: "timeLimit",
+                  TerminationCondition.infeasible: "infeasible", TerminationCondition.unbounded: "unbounded",
+                  TerminationCondition.infeasibleOrUnbounded: "infeasible"}.get(condition, "error")
+        if len(results.solution) == 0:
+            return MILPSolution(status, message=str(condition))
+        model.solutions.load_from(results)
+        x = np.array([model.x[j].value if model.x[j].value is not None else 0. for j in model.J])
+        return MILPSolution(status, x, value(model.obj), np.nan, str(condition))
+
+
+def makeSolver(spec=None, **kwargs):
+    # spec: highs, scipy or pyomo:<solver name>; None picks highs when highspy is installed, else scipy
+    if spec is None:
+        try:
+            return HighsSolver(**kwargs)
+        except ImportError:
+            return ScipySolver(**kwargs)
+    if spec == "highs":
+        return HighsSolver(**kwargs)
+    if spec == "scipy":
+        return ScipySolver(**kwargs)
+    if spec.startswith("pyomo:"):
+        return PyomoSolver(spec[len("pyomo:"):], **kwargs)
+    raise ValueError("unknown solver %s" % spec)
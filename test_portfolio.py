@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pyomo.environ import SolverFactory, value
+
+import portfolio
+from solvers import makeSolver
+
+
+def randomChain(n, seed):
+    # greeks of n options in the ranges of an ES chain's, scaled so the optimum holds a few legs
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(dict(conId=np.arange(1000, 1000 + n), delta=rng.uniform(-1, 1, n), gamma=rng.uniform(0, 1, n),
+                             theta=-rng.uniform(0, 0.15, n)))
+
+
+def exactSolver():
+    return makeSolver(mipGap=1e-9)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def testQuantityModelMatchesReplicated(seed):
+    raw = randomChain(10, seed)
+    solver = SolverFactory('highs')
+    if not solver.available(exception_flag=False):
+        pytest.skip("pyomo highs solver not available")
+    replicated = portfolio.buildModel(portfolio.replicateChain(raw))
+    solver.solve(replicated, options=dict(mip_rel_gap=1e-9))
+    quantity = portfolio.buildQuantityModel(raw)
+    solver.solve(quantity, options=dict(mip_rel_gap=1e-9))
+    model = portfolio.QuantityMILP(raw)
+    model.solve(exactSolver())
+    assert value(quantity.TotalProfit) == pytest.approx(value(replicated.TotalProfit), abs=1e-7)
+    assert model.objective == pytest.approx(value(replicated.TotalProfit), abs=1e-7)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def testInPlaceChangesMatchFreshModel(seed):
+    raw = randomChain(40, seed)
+    moved = randomChain(40, seed + 100)
+    solver = exactSolver()
+    model = portfolio.QuantityMILP(raw)
+    model.solve(solver)
+    model.updateGreeks(moved.delta, moved.gamma, moved.theta)
+    model.setBounds(0.2, (-2., 0.), 20.)
+    model.solve(solver)
+    fresh = portfolio.QuantityMILP(moved, deltaBound=0.2, thetaBounds=(-2., 0.), thetaWeight=20.)
+    fresh.solve(exactSolver())
+    assert model.objective == pytest.approx(fresh.objective, abs=1e-7)
+    assert model.isFeasible(fresh.solution.x) and fresh.isFeasible(model.solution.x)
+
+
+@pytest.mark.parametrize("thetaWeight", [10., 20.])
+def testPruneKeepsOptimum(thetaWeight):
+    raw = randomChain(6, 3)
+    rng = np.random.default_rng(3)
+    # the same options in seven other trading classes: equal delta and theta, gamma a little different
+    copies = [raw.assign(conId=raw.conId + 100 * (k + 1), gamma=raw.gamma * rng.uniform(0.9, 1.1, len(raw)))
+              for k in range(7)]
+    chain = pd.concat([raw] + copies, ignore_index=True)
+    pruned = portfolio.pruneChain(chain, thetaWeight=thetaWeight)
+    assert len(pruned) == 6 * 2 * 3
+    full = portfolio.QuantityMILP(chain, thetaWeight=thetaWeight)
+    full.solve(exactSolver())
+    model = portfolio.QuantityMILP(pruned, thetaWeight=thetaWeight)
+    model.solve(exactSolver())
+    assert model.objective == pytest.approx(full.objective, abs=1e-7)
+
+
+def testTopPortfoliosDistinctAndRanked():
+    raw = randomChain(12, 4)
+    model = portfolio.QuantityMILP(raw)
+    shape = model.A.shape
+    (ranking, rows) = portfolio.topPortfolios(model, 5, exactSolver())
+    assert len(ranking) == len(rows) == 5
+    held = [frozenset(conId for (conId, quantity) in legs) for legs in ranking.legs]
+    # the no-good cuts: no portfolio holds every option of a better one
+    assert all(not held[i] <= held[j] for i in range(5) for j in range(i + 1, 5))
+    assert np.all(np.diff(ranking.objective.values) <= 1e-9)
+    assert [set(r.conId) for r in rows] == [set(h) for h in held]
+    # the cuts are gone and the model holds the best portfolio again
+    assert model.A.shape == shape
+    assert model.objective == pytest.approx(ranking.objective[0])
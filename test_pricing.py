@@ -0,0 +1,25 @@
+import datetime
+
+import numpy as np
+
+from optionchain import OptionChainStore
+from pricing import VolSurface
+
+
+def testVolSurfaceSkipsUncomputedVol():
+    # a model tick for which TWS computed no vol arrives with impliedVol=None
+    now = datetime.datetime(2018, 10, 28)
+    store = OptionChainStore(capacity=8)
+    surface = VolSurface(now=now)
+    strikes = [2600., 2650., 2700., 2750., 2800., 2850.]
+    for (reqId, strike) in enumerate(strikes):
+        store.addRow(reqId, expirations="20181221", strikes=strike)
+    vols = [0.2, 0.18, 0.16, 0.15, 0.145, None]
+    for (reqId, vol) in enumerate(vols):
+        store.set(reqId, impliedVol=vol, undPrice=2700.)
+        surface.update("20181221", strikes[reqId], vol, 2700.)
+    surface.update("20181221", 2900., float('nan'), 2700.)
+    assert np.isnan(store['impliedVol'][5])
+    assert sorted(surface.quotes["20181221"]) == strikes[:5]
+    surface.updateChain(store)
+    assert np.isfinite(surface.vol(["20181221"], [2725.])).all()